@@ -2,18 +2,41 @@
 
 '''Entry point to the music server.'''
 
+import asyncio
 import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
 import hashlib
+import itertools
 import json
 import logging
+import multiprocessing
 import os
+import shutil
+import signal
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
 
 import gi
 gi.require_version('Gst', '1.0')
-from gi.repository import Gst
-import tornado.gen
+gi.require_version('GstNet', '1.0')
+gi.require_version('GstPbutils', '1.0')
+from gi.repository import GLib, Gst, GstNet, GstPbutils
+import pycurl
+import tornado.httpclient
 import tornado.ioloop
+import tornado.locks
+import tornado.queues
 
+import musicserver.utils.indexedlist as indexedlist
+import musicserver.utils.snapshot as snapshot
 import musicserver.utils.web as web
 
 __author__ = 'Antonio Serrano Hernandez'
@@ -28,16 +51,56 @@ __status__ = 'Development'
 ############################### Web interface #################################
 
 DEFAULT_PORT = 8888
+DEFAULT_IDLE_TIMEOUT = 60.0
+DEFAULT_WEB_WORKERS = 0
+DEFAULT_STATUS_SNAPSHOT_SIZE = 16 * 1024 * 1024
 DEFAULT_SONGDIR = '/var/lib/musicserver/songs'
 DEFAULT_PLAYLIST_SIZE = 10
-DEFAULT_EVENT_WAIT_TIME = 0.1
+DEFAULT_STORAGE_WORKERS = 2
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+DEFAULT_CACHE_COUNT = 1000
+DEFAULT_PREFETCH_WINDOW = 2
+DEFAULT_PREFETCH_BYTES = 128 * 1024 * 1024
+DEFAULT_POSITION_TICK = 0.25
+MAX_STATUS_WAIT_TIME = 60.0
+DEFAULT_MAX_SONG_SIZE = 256 * 1024 * 1024
+DEFAULT_DISCOVER_WORKERS = 2
+DEFAULT_DISCOVER_TIMEOUT = 10.0
+DEFAULT_METADATA_FLUSH_INTERVAL = 1.0
+DEFAULT_MAX_PLAYER_ERRORS = 3
+DEFAULT_SYNC_DELAY = 0.5
+DEFAULT_FETCH_STALL_TIMEOUT = 30
+DEFAULT_STREAM_BITRATE = 128
+DEFAULT_STREAM_CHUNK_SIZE = 4096
+DEFAULT_STREAM_BUFFER_CHUNKS = 64
+
+# posix_fadvise is not available in all the platforms
+_FADV_WILLNEED = getattr(os, 'POSIX_FADV_WILLNEED', None)
+_FADV_DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', None)
+
+# The batch of changes executed by the current task, if any
+_BATCH = contextvars.ContextVar('musicserver_batch', default=None)
 
 class Application:
-    '''Music server main application.'''
+    '''Music server main application.
+
+    If the musicserver.zones option is given, each zone has its own
+    MusicServer, with the options of the zone added to the musicserver ones,
+    served at /musicserver/<zone>/. All the zones share the same SongStore,
+    so a song is stored only once. Otherwise, there's only one MusicServer,
+    served at /musicserver/.
+
+    If the webserver.workers option is greater than 0, that many processes
+    receive the HTTP requests, sharing the TCP port, and forward them to this
+    process through a private Unix domain socket. This process keeps the
+    MusicServers, and publishes their status in shared memory, so the
+    workers can serve it by themselves. The webserver.unixsocket, if given,
+    is served by the first worker, as many processes can't share it.
+    '''
 
     def __init__(self, configuration=None):
         self._load_configuration(configuration)
-        self._setup_logger()
+        _setup_logger(self._configuration)
         self._setup_musicserver()
         self._start_webserver()
 
@@ -50,83 +113,364 @@ class Application:
             # By default, load an empty configuration
             self._configuration = {}
 
-    def _setup_logger(self):
-        '''Setup the logger.'''
-        logging_args = {
-            'format': '%(asctime)s: %(levelname)s: %(message)s',
-            'datefmt': '%b %d %H:%M:%S'
-        }
+    def _setup_musicserver(self):
+        '''Setup the Music Servers, by the base path of their web service.'''
+        self._store = _create_store(self._configuration)
+        self._musicservers = {}
         try:
-            logfile = self._configuration['general']['logfile']
-            logging_args['filename'] = logfile
-        except KeyError: pass
+            zones = self._configuration['musicserver']['zones']
+        except KeyError:
+            self._musicservers['musicserver'] = MusicServer(
+                self._configuration, self._store)
+            return
+        for zone, options in zones.items():
+            if not zone or '/' in zone:
+                raise ValueError(f'wrong zone name {zone}')
+            configuration = dict(self._configuration)
+            configuration['musicserver'] = dict(
+                self._configuration['musicserver'], **options)
+            self._musicservers[f'musicserver/{zone}'] = MusicServer(
+                configuration, self._store)
+
+    def _start_frontends(self):
+        '''Start the worker processes, and the publication of the status for
+        them.
+        '''
+        if not self._workers:
+            return
         try:
-            logging_args['level'] = self._configuration['general']['loglevel']
-        except KeyError: pass
-        logging.basicConfig(**logging_args)
-
-    def _setup_musicserver(self):
-        '''Setup the Music Server.'''
-        self._musicserver = MusicServer(self._configuration)
+            size = self._configuration['webserver']['statussnapshotsize']
+        except KeyError:
+            size = DEFAULT_STATUS_SNAPSHOT_SIZE
+        snapshots = {}
+        for i, (base, musicserver) in enumerate(self._musicservers.items()):
+            snapshots[base] = os.path.join(self._rundir, f'status{i}')
+            statussnapshot = snapshot.SharedSnapshot(snapshots[base], size)
+            subscriber = musicserver.publisher.subscribe(DEFAULT_POSITION_TICK)
+            tornado.ioloop.IOLoop.current().spawn_callback(subscriber.run,
+                functools.partial(
+                    self._write_status, musicserver, statussnapshot))
+
+        # The workers are spawned, not forked, so they don't inherit the
+        # player and the event loop
+        context = multiprocessing.get_context('spawn')
+        for i in range(self._workers):
+            process = context.Process(target=_run_frontend, args=(
+                self._configuration, self._backendsocket, snapshots, i == 0))
+            process.start()
+            self._frontends.append(process)
 
     def _start_webserver(self):
         '''Start the web interface.'''
+        webserver_args = _webserver_args(self._configuration)
         try:
-            port = self._configuration['webserver']['port']
+            self._workers = self._configuration['webserver']['workers']
         except KeyError:
-            port = DEFAULT_PORT
-        self._webserver = web.WebServer([], port=port)
-        self._service = web.WebService(
-            'musicserver', self._webserver, data=self._musicserver)
-
-        # Add the methods to the web service
-        self._service.addmethods([
-            ('clear', ClearMethod, web.WebService.GET),
-            ('enqueue', EnqueueMethod, web.WebService.POST),
-            ('next', NextMethod, web.WebService.GET),
-            ('pause', PauseMethod, web.WebService.GET),
-            ('play', PlayMethod, web.WebService.GET),
-            ('prev', PrevMethod, web.WebService.GET),
-            ('remove', RemoveMethod, web.WebService.GET),
-            ('seek', SeekMethod, web.WebService.GET),
-            ('setvolume', SetvolumeMethod, web.WebService.GET),
-            ('skipbackwards', SkipbackwardsMethod, web.WebService.GET),
-            ('skipforwards', SkipforwardsMethod, web.WebService.GET),
-            ('status', StatusMethod, web.WebService.GET),
-            ('stop', StopMethod, web.WebService.GET),
-        ])
+            self._workers = DEFAULT_WEB_WORKERS
+        self._frontends = []
+        if self._workers:
+            # Listen only for the workers, in a private directory
+            self._rundir = tempfile.mkdtemp(prefix='musicserver-')
+            self._backendsocket = os.path.join(self._rundir, 'backend.sock')
+            for arg in ['max_connections', 'max_client_connections',
+                    'unix_socket_mode']:
+                webserver_args.pop(arg, None)
+            webserver_args.update(
+                port=None, unix_socket=self._backendsocket)
+        self._webserver = web.WebServer([], **webserver_args)
+        for base, musicserver in self._musicservers.items():
+            web.WebSubscription(base, self._webserver, musicserver.publisher)
+
+            # Serve the live stream of the player, if any
+            if musicserver.livestream is not None:
+                self._webserver.addhandler(rf'/{base}/stream',
+                    web.LiveStreamHandler,
+                    data={'livestream': musicserver.livestream})
+
+            # Serve the files of the songs to the other music servers, before
+            # the web service that would take their path as a method
+            self._webserver.addhandler(rf'/{base}/songs/([0-9a-f]{{64}})',
+                web.HashFileHandler, data={'path': self._store.songdir,
+                    'executor': self._store.executor})
+            service = web.WebService(base, self._webserver, data=musicserver)
+
+            # Add the methods to the web service
+            service.addmethods([
+                ('batch', BatchMethod, web.WebService.POST),
+                ('clear', ClearMethod, web.WebService.GET),
+                ('enqueue', EnqueueMethod, web.WebService.STREAM),
+                ('enqueuehash', EnqueuehashMethod, web.WebService.GET),
+                ('has', HasMethod, web.WebService.GET),
+                ('insert', InsertMethod, web.WebService.GET),
+                ('move', MoveMethod, web.WebService.GET),
+                ('next', NextMethod, web.WebService.GET),
+                ('pause', PauseMethod, web.WebService.GET),
+                ('play', PlayMethod, web.WebService.GET),
+                ('prev', PrevMethod, web.WebService.GET),
+                ('remove', RemoveMethod, web.WebService.GET),
+                ('removeid', RemoveidMethod, web.WebService.GET),
+                ('seed', SeedMethod, web.WebService.GET),
+                ('seek', SeekMethod, web.WebService.GET),
+                ('setvolume', SetvolumeMethod, web.WebService.GET),
+                ('skipbackwards', SkipbackwardsMethod, web.WebService.GET),
+                ('skipforwards', SkipforwardsMethod, web.WebService.GET),
+                ('songs', SongsMethod, web.WebService.GET),
+                ('stats', StatsMethod, web.WebService.GET),
+                ('status', StatusMethod, web.WebService.GET),
+                ('stop', StopMethod, web.WebService.GET),
+                ('sync', SyncMethod, web.WebService.GET),
+            ])
+
+    async def _write_status(self, musicserver, statussnapshot, message):
+        '''Publish the status of a MusicServer for the workers, after every
+        change.
+        '''
+        result = web.WebServiceResult(musicserver.encodedstatus())
+        # If the status doesn't fit, the workers forward the requests
+        statussnapshot.write(web.encodesnapshot(
+            musicserver.statusheaders(), result.chunks()))
 
     def run(self):
         '''Run the main application.'''
         logging.info('starting')
-        self._webserver.run()
+        self._start_frontends()
+        try:
+            self._webserver.run()
+        finally:
+            for process in self._frontends:
+                process.terminate()
+                process.join()
+            if self._workers:
+                shutil.rmtree(self._rundir, ignore_errors=True)
         logging.info('exiting')
 
     def stop(self):
-        self._webserver.stop()
-        self._musicserver.close()
+        '''Stop the application. Can be called from any thread, or from a
+        signal handler: the music servers and the store are closed in the
+        IOLoop, once the web server doesn't serve any request.
+        '''
+        for process in self._frontends:
+            process.terminate()
+        self._webserver.stop(self._close)
 
     def ready(self):
         '''Return whether the server is ready or not.'''
         return self._webserver.ready()
 
+    def _close(self):
+        '''Close the music servers and the store.'''
+        for musicserver in self._musicservers.values():
+            musicserver.close()
+        self._store.close()
+
+class Frontend:
+    '''A worker process of the web interface, that forwards the requests to
+    the Application through the Unix domain socket backend, and serves the
+    status of each MusicServer from the SharedSnapshot in the file given in
+    snapshots, by the base path of its web service.
+
+    The worker listens in the TCP port, shared with the other workers, and,
+    if unixsocket, in the Unix domain socket of the configuration too.
+    '''
+
+    def __init__(self, configuration, backend, snapshots, unixsocket=False):
+        _setup_logger(configuration)
+
+        # The bodies are limited by the biggest song accepted in any zone,
+        # the Application checks the limit of each zone
+        musicserver = configuration.get('musicserver', {})
+        default = musicserver.get('maxsongsize', DEFAULT_MAX_SONG_SIZE)
+        zones = musicserver.get('zones', {}).values()
+        maxsongsize = max([default,
+            *(options.get('maxsongsize', default) for options in zones)])
+        webserver_args = _webserver_args(configuration)
+        if not unixsocket:
+            webserver_args.pop('unix_socket', None)
+        self._webserver = web.WebServer([], reuse_port=True, **webserver_args)
+        self._snapshots = []
+        for base, path in snapshots.items():
+            statussnapshot = snapshot.SharedSnapshot(path)
+            self._snapshots.append(statussnapshot)
+            self._webserver.addhandler(rf'/{base}/status',
+                web.SnapshotHandler,
+                data={'backend': backend, 'snapshot': statussnapshot})
+        self._webserver.addhandler(r'/.*', web.ProxyHandler,
+            data={'backend': backend, 'max_body_size': maxsongsize})
+
+    def run(self):
+        '''Run the worker.'''
+        logging.info(f'starting worker {os.getpid()}')
+        self._webserver.run()
+        for statussnapshot in self._snapshots:
+            statussnapshot.close()
+        logging.info(f'exiting worker {os.getpid()}')
+
+    def stop(self):
+        self._webserver.stop()
+
+def _run_frontend(configuration, backend, snapshots, unixsocket):
+    '''Entry point of the worker processes.'''
+    frontend = Frontend(configuration, backend, snapshots, unixsocket)
+
+    # The Application stops the workers when it's interrupted
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *args: frontend.stop())
+    frontend.run()
+
+def _setup_logger(configuration):
+    '''Setup the logger.'''
+    logging_args = {
+        'format': '%(asctime)s: %(levelname)s: %(message)s',
+        'datefmt': '%b %d %H:%M:%S'
+    }
+    try:
+        logfile = configuration['general']['logfile']
+        logging_args['filename'] = logfile
+    except KeyError: pass
+    try:
+        logging_args['level'] = configuration['general']['loglevel']
+    except KeyError: pass
+    logging.basicConfig(**logging_args)
+
+def _webserver_args(configuration):
+    '''Return the arguments of the web.WebServer from the configuration.'''
+    # Get the TCP port, that may be null to listen only in the Unix domain
+    # socket
+    try:
+        port = configuration['webserver']['port']
+    except KeyError:
+        port = DEFAULT_PORT
+    try:
+        chunk_size = configuration['webserver']['chunksize']
+    except KeyError:
+        chunk_size = None
+    webserver_args = {'port': port, 'chunk_size': chunk_size}
+
+    # Get the parameters of the connections, see web.WebServer
+    for key, arg in [
+            ('keepalive', 'keep_alive'),
+            ('idletimeout', 'idle_timeout'),
+            ('bodytimeout', 'body_timeout'),
+            ('maxbodysize', 'max_body_size'),
+            ('maxheadersize', 'max_header_size'),
+            ('maxconnections', 'max_connections'),
+            ('maxclientconnections', 'max_client_connections')]:
+        try:
+            webserver_args[arg] = configuration['webserver'][key]
+        except KeyError: pass
+    webserver_args.setdefault('idle_timeout', DEFAULT_IDLE_TIMEOUT)
+
+    # Get the Unix domain socket, and its permissions in octal, as a string
+    # or as a number written with the octal digits, like chmod's
+    try:
+        webserver_args['unix_socket'] = (
+            configuration['webserver']['unixsocket'])
+    except KeyError: pass
+    try:
+        mode = configuration['webserver']['unixsocketmode']
+    except KeyError: pass
+    else:
+        try:
+            webserver_args['unix_socket_mode'] = int(str(mode), 8)
+        except ValueError:
+            raise ValueError(f'wrong webserver.unixsocketmode {mode!r}, '
+                'must be an octal mode as "660"')
+    return webserver_args
+
+def _change(execute):
+    '''Decorate the execute method of a web service method that changes the
+    playlist or the player, see MusicServer.change.
+    '''
+    @functools.wraps(execute)
+    async def wrapper(self, *args, **kwargs):
+        async with self.data.change():
+            return await execute(self, *args, **kwargs)
+    return wrapper
+
+class BatchMethod(web.BatchWebServiceMethod):
+    '''Web Service batch method.'''
+
+    def transaction(self, atomic):
+        '''Execute the methods in a batch of the music server.'''
+        return self.data.batch(atomic)
+
 class ClearMethod(web.WebServiceMethod):
     '''Web Service clear method.'''
 
+    @_change
     async def execute(self):
         '''Remove all songs from the playlist.'''
         self.data.clear()
 
-class EnqueueMethod(web.WebServiceMethod):
-    '''Web Service enqueue method.'''
+class EnqueueMethod(web.StreamWebServiceMethod):
+    '''Web Service enqueue method.
+
+    The song is received in chunks and written to disk as it arrives, so it is
+    never held entirely in memory.
+    '''
+
+    def max_body_size(self):
+        '''Return the maximum size of the song accepted.'''
+        return self.data.maxsongsize
 
+    def begin(self):
+        '''Start the reception of the song.'''
+        self._upload = self.data.newupload()
+
+    async def data_received(self, chunk):
+        '''Receive a chunk of the song.'''
+        await self._upload.write(chunk)
+
+    @_change
     async def execute(self, title):
         '''Enqueue a song to the playlist.'''
-        self.data.enqueue(title, self.request.body)
+        await self.data.enqueueupload(title, self._upload)
+
+    def close(self):
+        '''Discard the song if it was not enqueued.'''
+        try:
+            self._upload.discard()
+        except AttributeError: pass
+
+class EnqueuehashMethod(web.WebServiceMethod):
+    '''Web Service enqueuehash method.'''
+
+    @_change
+    async def execute(self, title, hash):
+        '''Enqueue a song already stored in the server, given its hash.'''
+        await self.data.enqueuehash(title, hash)
+
+class HasMethod(web.WebServiceMethod):
+    '''Web Service has method.'''
+
+    async def execute(self, hash):
+        '''Return which of the given comma separated hashes are stored in the
+        server.
+        '''
+        return self.data.has(hash.split(','))
+
+class InsertMethod(web.WebServiceMethod):
+    '''Web Service insert method.'''
+
+    @_change
+    async def execute(self, index, title, hash):
+        '''Insert a song already stored in the server, given its hash,
+        before the given index.
+        '''
+        await self.data.insert(int(index), title, hash)
+
+class MoveMethod(web.WebServiceMethod):
+    '''Web Service move method.'''
+
+    @_change
+    async def execute(self, src, dst):
+        '''Move a song in the playlist.'''
+        self.data.move(int(src), int(dst))
 
 class NextMethod(web.WebServiceMethod):
     '''Web Service next method.'''
 
+    @_change
     async def execute(self):
         '''Go to the next song in the playlist.'''
         self.data.next()
@@ -134,6 +478,7 @@ class NextMethod(web.WebServiceMethod):
 class PauseMethod(web.WebServiceMethod):
     '''Web Service pause method.'''
 
+    @_change
     async def execute(self):
         '''Set the player to pause.'''
         self.data.pause()
@@ -141,6 +486,7 @@ class PauseMethod(web.WebServiceMethod):
 class PlayMethod(web.WebServiceMethod):
     '''Web Service play method.'''
 
+    @_change
     async def execute(self):
         '''Set the player to play.'''
         self.data.play()
@@ -148,6 +494,7 @@ class PlayMethod(web.WebServiceMethod):
 class PrevMethod(web.WebServiceMethod):
     '''Web Service prev method.'''
 
+    @_change
     async def execute(self):
         '''Go to the previous song in the playlist.'''
         self.data.prev()
@@ -155,13 +502,32 @@ class PrevMethod(web.WebServiceMethod):
 class RemoveMethod(web.WebServiceMethod):
     '''Web Service remove method.'''
 
+    @_change
     async def execute(self, index):
         '''Remove a song the playlist.'''
         self.data.remove(int(index))
 
+class RemoveidMethod(web.WebServiceMethod):
+    '''Web Service removeid method.'''
+
+    @_change
+    async def execute(self, id):
+        '''Remove a song the playlist, given its id.'''
+        self.data.removeid(int(id))
+
+class SeedMethod(web.WebServiceMethod):
+    '''Web Service seed method.'''
+
+    async def execute(self, peer=None):
+        '''Fetch the songs stored in the given peer, or in all the peers,
+        that are not stored in this server. Return their hashes.
+        '''
+        return await self.data.seed(peer)
+
 class SeekMethod(web.WebServiceMethod):
     '''Web Service seek method.'''
 
+    @_change
     async def execute(self, position):
         '''Seek the current song to the given position.'''
         self.data.seek(float(position))
@@ -169,6 +535,7 @@ class SeekMethod(web.WebServiceMethod):
 class SetvolumeMethod(web.WebServiceMethod):
     '''Web Service setvolume method.'''
 
+    @_change
     async def execute(self, volume):
         '''Set the player's volume.'''
         self.data.setvolume(float(volume))
@@ -176,6 +543,7 @@ class SetvolumeMethod(web.WebServiceMethod):
 class SkipbackwardsMethod(web.WebServiceMethod):
     '''Web Service skipbackwards method.'''
 
+    @_change
     async def execute(self):
         '''Move the current position a bit backwards.'''
         self.data.skipbackwards()
@@ -183,47 +551,347 @@ class SkipbackwardsMethod(web.WebServiceMethod):
 class SkipforwardsMethod(web.WebServiceMethod):
     '''Web Service skipforwards method.'''
 
+    @_change
     async def execute(self):
         '''Move the current position a bit forwards.'''
         self.data.skipforwards()
 
+class SongsMethod(web.WebServiceMethod):
+    '''Web Service songs method.'''
+
+    async def execute(self):
+        '''Return the hashes of all the songs stored in the server.'''
+        return self.data.songs()
+
+class StatsMethod(web.WebServiceMethod):
+    '''Web Service stats method.'''
+
+    async def execute(self):
+        '''Return the statistics of the system.'''
+        stats = self.data.stats()
+        stats['webserver'] = self.server.stats()
+        return stats
+
 class StatusMethod(web.WebServiceMethod):
     '''Web Service status method.'''
 
-    async def execute(self):
-        '''Return the status of the system.'''
-        return self.data.status()
+    async def execute(self, since=None, timeout=None, offset=None,
+            limit=None, around=None, fields=None):
+        '''Return the status of the system.
+
+        If since is given, wait until the version of the status is newer
+        than it, or until timeout seconds have elapsed. Waiting is not
+        allowed inside a batch, that would delay the whole batch.
+
+        Only the songs from offset, up to limit songs, are returned. If
+        around is 'current', offset is relative to the current song. If
+        fields is given, only those comma separated fields of the songs are
+        returned. The number of songs in the playlist and their total
+        duration are returned in the X-Playlist-Count and
+        X-Playlist-Duration headers.
+        '''
+        if since is not None:
+            if self.batched:
+                raise ValueError('since not allowed in batches')
+            timeout = float(timeout) if timeout is not None else None
+            await self.data.waitchange(since, timeout)
+
+        # Answer Not Modified if the client already has this version
+        self.headers.update(self.data.statusheaders())
+        etag = self.headers.get('Etag')
+        if etag is not None and self.etagmatches(etag):
+            raise web.NotModified()
+
+        if offset is None and limit is None and around is None \
+                and fields is None:
+            return self.data.encodedstatus()
+        return self.data.status(int(offset) if offset is not None else 0,
+            int(limit) if limit is not None else None, around,
+            fields.split(',') if fields is not None else None)
 
 class StopMethod(web.WebServiceMethod):
     '''Web Service stop method.'''
 
+    @_change
     async def execute(self):
         '''Set the player to stop.'''
         self.data.stop()
 
+class SyncMethod(web.WebServiceMethod):
+    '''Web Service sync method.'''
+
+    async def execute(self):
+        '''Return the state of the player for the servers that follow this
+        one.
+        '''
+        return self.data.sync()
+
+
 ############################### Core services #################################
 
+class MetadataStore:
+    '''Keeps the metadata of the songs, keyed by their hash, in a SQLite
+    database, so it survives restarts and the songs stored again don't need
+    to be discovered.
+
+    All the metadata is kept in memory too, so reading it doesn't touch the
+    database. The changes are written in batches, in a worker thread, at most
+    every interval seconds. If no path is given, the metadata is only kept in
+    memory.
+    '''
+
+    _COLUMNS = ('hash', 'discovered', 'decodable', 'duration', 'codec',
+        'bitrate', 'channels', 'tags', 'titles', 'firstseen', 'lastplayed',
+        'plays', 'failures')
+
+    def __init__(self, path=None, interval=DEFAULT_METADATA_FLUSH_INTERVAL):
+        self._interval = interval
+        self._index = {}
+        self._dirty = set()
+        self._flushing = False
+        self._connection = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(1)
+        if path is not None:
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            self._load()
+
+    def close(self):
+        '''Write the pending changes and close the database.'''
+        rows = [self._row(h) for h in list(self._dirty)]
+        self._dirty = set()
+        if rows:
+            self._executor.submit(self._write, rows)
+        self._executor.shutdown(wait=True)
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def get(self, hash_):
+        '''Return the metadata of a song, creating it if it's not known.'''
+        try:
+            return self._index[hash_]
+        except KeyError:
+            metadata = self._index[hash_] = SongMetadata()
+            metadata.firstseen = time.time()
+            self.save(hash_)
+            return metadata
+
+    def save(self, hash_):
+        '''Schedule the write of the metadata of a song.'''
+        if self._connection is None:
+            return
+        self._dirty.add(hash_)
+        self._schedule()
+
+    async def _flush(self):
+        '''Write the changes pending in a worker thread.'''
+        rows = [self._row(h) for h in self._dirty]
+        self._dirty = set()
+        try:
+            if rows and self._connection is not None:
+                await tornado.ioloop.IOLoop.current().run_in_executor(
+                    self._executor, self._write, rows)
+        except RuntimeError:
+            # The store was closed in the meantime
+            pass
+        finally:
+            self._flushing = False
+        self._schedule()
+
+    def _load(self):
+        '''Create the database if necessary and load its contents.'''
+        with self._connection:
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS songs (
+                hash TEXT PRIMARY KEY,
+                discovered INTEGER NOT NULL,
+                decodable INTEGER NOT NULL,
+                duration REAL,
+                codec TEXT,
+                bitrate INTEGER,
+                channels INTEGER,
+                tags TEXT,
+                titles TEXT NOT NULL,
+                firstseen REAL NOT NULL,
+                lastplayed REAL,
+                plays INTEGER NOT NULL,
+                failures INTEGER NOT NULL)''')
+        columns = ', '.join(self._COLUMNS)
+        for row in self._connection.execute(f'SELECT {columns} FROM songs'):
+            metadata = SongMetadata()
+            for name, value in zip(self._COLUMNS[1:], row[1:]):
+                setattr(metadata, name, value)
+            metadata.discovered = bool(metadata.discovered)
+            metadata.decodable = bool(metadata.decodable)
+            if metadata.tags is not None:
+                metadata.tags = json.loads(metadata.tags)
+            metadata.titles = json.loads(metadata.titles)
+            self._index[row[0]] = metadata
+
+    def _row(self, hash_):
+        '''Return the row of the database of a song.'''
+        m = self._index[hash_]
+        tags = json.dumps(m.tags) if m.tags is not None else None
+        return (hash_, int(m.discovered), int(m.decodable), m.duration,
+            m.codec, m.bitrate, m.channels, tags, json.dumps(m.titles),
+            m.firstseen, m.lastplayed, m.plays, m.failures)
+
+    def _schedule(self):
+        '''Schedule a write of the changes pending, if not scheduled yet.'''
+        if self._dirty and not self._flushing:
+            self._flushing = True
+            tornado.ioloop.IOLoop.current().call_later(
+                self._interval, self._flush)
+
+    def _write(self, rows):
+        '''Write the given rows to the database, in a single transaction.'''
+        columns = ', '.join(self._COLUMNS)
+        values = ', '.join('?' * len(self._COLUMNS))
+        with self._connection:
+            self._connection.executemany(
+                f'INSERT OR REPLACE INTO songs ({columns}) VALUES ({values})',
+                rows)
+
 class MusicServer:
-    '''MusicServer interface.'''
+    '''MusicServer interface.
+
+    The songs are kept in the given SongStore, that may be shared with other
+    MusicServers, or in one of its own if not given.
+
+    Many music servers can play in sync. The leader, configured with the
+    syncclockport option, serves its clock in that UDP port, and publishes
+    what it plays, and when, in sync messages. The followers, configured
+    with the URL of the web service of the leader in the syncleader option,
+    use the clock of the leader and play the same songs at the same times.
+    The followers need the songs in their stores.
+    '''
+
+    _FOLLOW_RETRY_TIME = 1.0
+
+    def __init__(self, configuration, store=None):
+        # Create the publisher of the changes of state. Every change, but the
+        # position ticks, increases the version of the status. The version
+        # includes an epoch, random for every start, so the versions of
+        # previous starts are never taken as the current one
+        self._publisher = web.Publisher(self.encodedstatus)
+        self._epoch = os.urandom(4).hex()
+        self._version = 0
+        self._versionchanged = tornado.locks.Condition()
+
+        # The playlist serialized, and the version of the status it belongs
+        # to
+        self._encodedplaylist = None
+        self._encodedversion = None
+
+        # The number of songs in the playlist and their total duration, and
+        # the version of the status they belong to
+        self._totals = None
+        self._totalsversion = None
+
+        # The atomic batches are executed one at a time, and while one is
+        # executed the other changes wait for it
+        self._batchlock = tornado.locks.Lock()
+        self._atomicbatch = None
+        self._changes = 0
+        self._changesdone = tornado.locks.Condition()
+
+        # Create the live stream of what the player plays, if enabled
+        try:
+            stream = configuration['musicserver']['stream']
+        except KeyError:
+            stream = False
+        try:
+            streambitrate = configuration['musicserver']['streambitrate']
+        except KeyError:
+            streambitrate = DEFAULT_STREAM_BITRATE
+        try:
+            maxlisteners = configuration['musicserver']['streammaxlisteners']
+        except KeyError:
+            maxlisteners = None
+        self._livestream = None
+        if stream:
+            self._livestream = web.LiveStream('audio/mpeg',
+                DEFAULT_STREAM_CHUNK_SIZE, DEFAULT_STREAM_BUFFER_CHUNKS,
+                maxlisteners)
 
-    def __init__(self, configuration):
         # Create the player. This MusicServer is its listener
-        self._player = Player(self)
+        try:
+            standby = configuration['musicserver']['standby']
+        except KeyError:
+            standby = False
+        self._player = Player(self, standby, self._livestream, streambitrate)
 
         # Create the playlist
-        self._create_playlist(configuration)
+        self._ownstore = store is None
+        if store is None:
+            store = _create_store(configuration)
+        self._create_playlist(configuration, store)
 
-        # Start the player's event loop
-        tornado.ioloop.IOLoop.current().spawn_callback(self._player.run)
+        # Get the maximum size of the songs accepted
+        try:
+            self._maxsongsize = configuration['musicserver']['maxsongsize']
+        except KeyError:
+            self._maxsongsize = DEFAULT_MAX_SONG_SIZE
 
-    def _create_playlist(self, configuration):
-        '''Create the playlist instance.'''
-        # Get the directory where the songs will be stored
+        # Get the number of songs that may fail in a row before stopping
         try:
-            songdir = configuration['musicserver']['songdir']
+            self._maxplayererrors = (
+                configuration['musicserver']['maxplayererrors'])
         except KeyError:
-            songdir = DEFAULT_SONGDIR
+            self._maxplayererrors = DEFAULT_MAX_PLAYER_ERRORS
+        self._playererrors = 0
+        self._consecutiveerrors = 0
 
+        # Get the number of songs, and their size, read ahead from disk
+        try:
+            self._prefetchwindow = (
+                configuration['musicserver']['prefetchwindow'])
+        except KeyError:
+            self._prefetchwindow = DEFAULT_PREFETCH_WINDOW
+        try:
+            self._prefetchbytes = configuration['musicserver']['prefetchbytes']
+        except KeyError:
+            self._prefetchbytes = DEFAULT_PREFETCH_BYTES
+
+        # Create the timer that publishes the position while playing
+        self._positiontick = tornado.ioloop.PeriodicCallback(
+            self._publishposition, DEFAULT_POSITION_TICK * 1000)
+
+        # Play in sync with other music servers, as their leader or as a
+        # follower
+        try:
+            self._syncdelay = configuration['musicserver']['syncdelay']
+        except KeyError:
+            self._syncdelay = DEFAULT_SYNC_DELAY
+        try:
+            self._clockport = configuration['musicserver']['syncclockport']
+        except KeyError:
+            self._clockport = None
+        try:
+            self._leader = configuration['musicserver']['syncleader']
+        except KeyError:
+            self._leader = None
+        self._scheduled = ('stop', None, None)
+        self._lastsync = None
+        self._leadersync = None
+        self._followedbasetime = None
+        self._followqueue = tornado.queues.Queue()
+        self._closed = False
+        self._timeprovider = None
+        if self._clockport is not None:
+            clock = Gst.SystemClock.obtain()
+            self._timeprovider = GstNet.NetTimeProvider.new(
+                clock, None, self._clockport)
+            self._player.setclock(clock, self._syncdelay)
+
+        # Start the player's event loop
+        tornado.ioloop.IOLoop.current().spawn_callback(self._player.run)
+        if self._leader is not None:
+            tornado.ioloop.IOLoop.current().spawn_callback(self._follow)
+            tornado.ioloop.IOLoop.current().spawn_callback(
+                self._followmessages)
+
+    def _create_playlist(self, configuration, store):
+        '''Create the playlist instance.'''
         # Get the playlist size
         try:
             playlistsize = configuration['musicserver']['playlistsize']
@@ -231,7 +899,94 @@ class MusicServer:
             playlistsize = DEFAULT_PLAYLIST_SIZE
 
         # Create the playlist
-        self._playlist = Playlist(songdir, playlistsize)
+        self._playlist = Playlist(store, playlistsize, self)
+
+    @property
+    def etag(self):
+        '''Return the ETag of the status, or None if it changes all the time
+        because the player is playing.
+        '''
+        if self._player.state == 'play':
+            return None
+        return f'"{self.version}"'
+
+    @property
+    def publisher(self):
+        '''Return the publisher of the changes of state.'''
+        return self._publisher
+
+    @property
+    def maxsongsize(self):
+        '''Return the maximum size of the songs accepted, in bytes.'''
+        return self._maxsongsize
+
+    @property
+    def livestream(self):
+        '''Return the live stream of the player, or None if disabled.'''
+        return self._livestream
+
+    @property
+    def version(self):
+        '''Return the version of the status, as epoch.number.'''
+        return f'{self._epoch}.{self._version}'
+
+    @contextlib.asynccontextmanager
+    async def batch(self, atomic=False):
+        '''Execute many changes as a batch, in the current task.
+
+        The waiters of the status are woken up, and the next song of the
+        player is updated, only once, at the end of the batch. The changes
+        made by other tasks meanwhile are not delayed.
+
+        The atomic batches are executed one at a time, and the changes made
+        with change by other tasks wait until they finish. If an exception is
+        raised from an atomic batch, the playlist and the player are restored
+        to their state before it, but the position of the song.
+        '''
+        batch = _Batch(self)
+        async with contextlib.AsyncExitStack() as stack:
+            snapshot = None
+            if atomic:
+                await stack.enter_async_context(self._batchlock)
+                self._atomicbatch = batch
+                stack.callback(self._endatomicbatch)
+                while self._changes:
+                    await self._changesdone.wait()
+                snapshot = (self._playlist.snapshot(), self._player.state,
+                    self._player.volume)
+            token = _BATCH.set(batch)
+            try:
+                yield
+            except Exception:
+                if snapshot is not None:
+                    self._restore(*snapshot)
+                    snapshot = None
+                raise
+            finally:
+                _BATCH.reset(token)
+                if snapshot is not None:
+                    self._playlist.discard(snapshot[0])
+                self._endbatch(batch)
+
+    @contextlib.asynccontextmanager
+    async def change(self):
+        '''Make a change to the playlist or the player from the web service.
+
+        The change waits for the atomic batch being executed, if any, unless
+        it is part of it, so that the batch can't undo it.
+        '''
+        batch = _BATCH.get()
+        if batch is not None and batch is self._atomicbatch:
+            yield
+            return
+        while self._atomicbatch is not None:
+            await self._changesdone.wait()
+        self._changes += 1
+        try:
+            yield
+        finally:
+            self._changes -= 1
+            self._changesdone.notify_all()
 
     def clear(self):
         '''Clear all songs in the playlist.'''
@@ -240,14 +995,66 @@ class MusicServer:
 
         # Then, clear the playlist
         self._playlist.clear()
+        self._updatenext()
 
     def close(self):
         '''Tell the music server that we're closing.'''
+        self._closed = True
         self._player.close()
+        if self._livestream is not None:
+            self._livestream.close()
+        if self._ownstore:
+            self._playlist.close()
 
-    def enqueue(self, title, data):
+    def encodedstatus(self):
+        '''Return the status of the system serialized as json.
+
+        The playlist is only serialized again when the version of the status
+        changes.
+        '''
+        # The status of the player may change the version
+        player = json.dumps(self._player.status().serialize()).encode('utf-8')
+        if self._encodedversion != self._version:
+            self._encodedplaylist = self._playlist.encodedstatus()
+            self._encodedversion = self._version
+        return web.EncodedJSON(b'{"playlist": ', self._encodedplaylist,
+            b', "player": ', player,
+            b', "version": ', json.dumps(self.version).encode('utf-8'), b'}')
+
+    async def enqueue(self, title, data):
         '''Enqueue a song given its search id.'''
-        self._playlist.enqueue(title, data)
+        await self._playlist.enqueue(title, data)
+        self._updatenext()
+
+    async def enqueuehash(self, title, hash_):
+        '''Enqueue a song already stored, given its hash.'''
+        await self._playlist.enqueuehash(title, hash_)
+        self._updatenext()
+
+    async def enqueueupload(self, title, upload):
+        '''Enqueue a song received with an upload.'''
+        await self._playlist.enqueueupload(title, upload)
+        self._updatenext()
+
+    def has(self, hashes):
+        '''Return the hashes, from the given ones, of the songs stored.'''
+        return self._playlist.has(hashes)
+
+    def newupload(self):
+        '''Return a new upload to receive a song in chunks.'''
+        return self._playlist.newupload()
+
+    async def insert(self, index, title, hash_):
+        '''Insert a song already stored, given its hash, before the given
+        index.
+        '''
+        await self._playlist.insert(index, title, hash_)
+        self._updatenext()
+
+    def move(self, src, dst):
+        '''Move a song in the playlist.'''
+        self._playlist.move(src, dst)
+        self._updatenext()
 
     def next(self):
         '''Go to the next song in the playlist.'''
@@ -260,7 +1067,8 @@ class MusicServer:
 
         # If the player was playing, set it to play
         if player_state == 'play':
-            self._player.play(self._playlist.current)
+            self._player.skip(self._playlist.current)
+        self._updatenext()
 
     def pause(self):
         '''Set the player to play.'''
@@ -285,7 +1093,8 @@ class MusicServer:
 
         # If the player was playing before, set it to play
         if player_state == 'play':
-            self._player.play(self._playlist.current)
+            self._player.skip(self._playlist.current)
+        self._updatenext()
 
     def playereos(self):
         '''The EOS (End Of Stream) condition was received by the player.'''
@@ -294,12 +1103,87 @@ class MusicServer:
             self.next()
         except IndexError: pass
 
-    def playererror(self, msg):
-        '''An error was detected by the player.'''
+    def playerdurationchanged(self, song):
+        '''The player has learnt the duration of a song.'''
+        self._playlist.durationchanged(song)
+        if self._playlist.current is song:
+            index = self._playlist.currentindex
+        else:
+            index = None
+        self._publish(
+            {'type': 'duration', 'index': index, 'duration': song.duration})
+
+    def playererror(self, song, msg):
+        '''An error was detected by the player while playing the given
+        song.
+
+        The song is skipped and the next one is played, unless too many songs
+        failed in a row.
+        '''
         err, debuginfo = msg.parse_error()
         logging.error(
             f'error in pipeline: {msg.src.get_name()}: {err.message}')
         logging.error(f"debug info: {debuginfo if debuginfo else 'none'}")
+        self._player.stop()
+        self._playererrors += 1
+        if song is not None:
+            self._playlist.failed(song)
+
+        # Skip to the next song
+        self._consecutiveerrors += 1
+        if self._consecutiveerrors > self._maxplayererrors:
+            logging.error('too many songs failed in a row, stopping')
+            self._consecutiveerrors = 0
+            return
+        try:
+            self._playlist.next()
+        except IndexError:
+            self._consecutiveerrors = 0
+            return
+        self._player.skip(self._playlist.current)
+        self._updatenext()
+
+    def playerstatechanged(self, state):
+        '''The state of the player has changed.'''
+        if state == 'play':
+            self._positiontick.start()
+        else:
+            self._positiontick.stop()
+        self._publishplayer()
+
+    def playerscheduled(self, state, song, position, basetime):
+        '''The player scheduled a song to play from position at the time
+        basetime of its clock, or paused or stopped.
+        '''
+        self._scheduled = (state, position, basetime)
+        self._publishsync()
+
+    def playerstarted(self, song):
+        '''The player started to play a song.'''
+        self._consecutiveerrors = 0
+        self._playlist.played(song)
+
+    def playertrackchanged(self, song):
+        '''The player started to play the next song without gaps.'''
+        self._consecutiveerrors = 0
+        self._playlist.played(song)
+        if self._playlist.upcoming is song:
+            self._playlist.next()
+            self._updatenext()
+        else:
+            # The playlist changed after the song was queued in the player,
+            # play the right song instead
+            try:
+                self.next()
+            except IndexError: pass
+        if self._leadersync is not None:
+            # Catch up with the leader, that may have changed the next song
+            self._followqueue.put_nowait(
+                {'type': 'sync', **self._leadersync})
+
+    def playlistchanged(self, change):
+        '''The playlist has changed.'''
+        self._publish(change)
 
     def remove(self, index):
         '''Remove the given song from the playlist.'''
@@ -313,35 +1197,90 @@ class MusicServer:
             self._playlist.remove(index)
             song = self._playlist.current
             if player_state == 'play' and song:
-                self._player.play(song)
+                self._player.skip(song)
+            self._updatenext()
         else:
             # if not, simply remove the song
             self._playlist.remove(index)
+            self._updatenext()
+
+    def removeid(self, id_):
+        '''Remove the song with the given id from the playlist.'''
+        self.remove(self._playlist.indexof(id_))
+
+    async def seed(self, peer=None):
+        '''Fetch the songs stored in the given peer, or in all the peers,
+        that are not stored here. Return their hashes.
+        '''
+        return await self._playlist.seed(peer)
 
     def seek(self, position):
         '''Seek the current song to the given position.'''
         # Seek only if the player is not stopped
         self._player.seek(position)
+        self._publishplayer()
 
     def setvolume(self, volume):
         '''Set the player's volume.'''
         self._player.setvolume(volume)
+        self._publishplayer()
 
     def skipbackwards(self):
         '''Move the stream position a fixed amount backwards.'''
         self._player.skipbackwards()
+        self._publishplayer()
 
     def skipforwards(self):
         '''Move the stream position a fixed amount forwards.'''
         self._player.skipforwards()
+        self._publishplayer()
 
-    def status(self):
-        '''Return the status of the system.'''
+    def songs(self):
+        '''Return the hashes of all the songs stored.'''
+        return self._playlist.songs()
+
+    def stats(self):
+        '''Return the statistics of the system.'''
+        return {'player': self._player.stats(),
+            'playererrors': self._playererrors,
+            'listeners': (len(self._livestream)
+                if self._livestream is not None else None)}
+
+    def status(self, offset=0, limit=None, around=None, fields=None):
+        '''Return the status of the system.
+
+        Only the songs from offset, up to limit songs, are returned. If
+        around is 'current', offset is relative to the current song. If
+        fields is given, only those fields of the songs are returned.
+        '''
+        if around == 'current':
+            offset += self._playlist.currentindex or 0
+        elif around is not None:
+            raise ValueError('wrong around value')
+        if limit is not None and limit < 0:
+            raise ValueError('limit must be non-negative')
+        player = self._player.status().serialize()
         return {
-            'playlist': self._playlist.status().serialize(),
-            'player': self._player.status().serialize()
+            'playlist': self._playlist.status(
+                max(offset, 0), limit, fields).serialize(),
+            'player': player,
+            'version': self.version
         }
 
+    def statusheaders(self):
+        '''Return the headers of the responses with the status: the ETag,
+        if any, and the number of songs in the playlist and their total
+        duration.
+        '''
+        headers = {}
+        etag = self.etag
+        if etag is not None:
+            headers['Etag'] = etag
+        count, duration = self.totals()
+        headers['X-Playlist-Count'] = str(count)
+        headers['X-Playlist-Duration'] = str(duration)
+        return headers
+
     def stop(self):
         '''Set the player to stop.'''
         if self._player.state == 'stop':
@@ -349,8 +1288,267 @@ class MusicServer:
         else:
             self._player.stop()
 
+    def sync(self):
+        '''Return the state of the player for the music servers that follow
+        this one.
+        '''
+        if self._timeprovider is None:
+            raise ValueError('not a sync leader')
+        state, position, basetime = self._scheduled
+        song = self._playlist.current
+        upcoming = self._playlist.upcoming
+        return {
+            'clockport': self._clockport,
+            'state': state,
+            'song': {'hash': song.hash, 'title': song.title}
+                if song is not None else None,
+            'next': {'hash': upcoming.hash, 'title': upcoming.title}
+                if upcoming is not None else None,
+            'position': position,
+            'basetime': basetime,
+        }
+
+    def totals(self):
+        '''Return the number of songs in the playlist and their total
+        duration, of the songs whose duration is known.
+        '''
+        if self._totalsversion != self._version:
+            self._totals = self._playlist.totals()
+            self._totalsversion = self._version
+        return self._totals
+
+    async def waitchange(self, version, timeout=None):
+        '''Wait until the version of the status is newer than the given one,
+        or until timeout seconds have elapsed. The versions of previous
+        starts of the server are always older.
+        '''
+        epoch, _, number = version.rpartition('.')
+        try:
+            version = int(number)
+        except ValueError:
+            raise ValueError('wrong version')
+        if epoch != self._epoch:
+            return
+        if timeout is None or timeout > MAX_STATUS_WAIT_TIME:
+            timeout = MAX_STATUS_WAIT_TIME
+        deadline = tornado.ioloop.IOLoop.current().time() + timeout
+        while self._version <= version:
+            if not await self._versionchanged.wait(deadline):
+                break
+
+    def _batch(self):
+        '''Return the batch being executed in this music server by the
+        current task, if any.
+        '''
+        batch = _BATCH.get()
+        if batch is None or batch.musicserver is not self or not batch.active:
+            return None
+        return batch
+
+    def _endatomicbatch(self):
+        '''Let the changes waiting for an atomic batch be made.'''
+        self._atomicbatch = None
+        self._changesdone.notify_all()
+
+    def _endbatch(self, batch):
+        '''Do the work delayed while executing a batch.'''
+        batch.active = False
+        if batch.pendingupdatenext:
+            self._updatenext()
+        if batch.pendingnotify:
+            self._versionchanged.notify_all()
+
+    async def _follow(self):
+        '''Receive the messages of the leader, reconnecting when the
+        connection is lost.
+        '''
+        client = tornado.httpclient.AsyncHTTPClient()
+        while not self._closed:
+            events = bytearray()
+            def received(chunk):
+                events.extend(chunk)
+                while b'\n\n' in events:
+                    event, _, rest = bytes(events).partition(b'\n\n')
+                    events[:] = rest
+                    if event.startswith(b'data: '):
+                        self._followqueue.put_nowait(json.loads(event[6:]))
+            try:
+                await client.fetch(f'{self._leader}/events',
+                    streaming_callback=received, request_timeout=0)
+            except Exception as e:
+                logging.warning(f'cannot follow {self._leader}: {e}')
+            await asyncio.sleep(self._FOLLOW_RETRY_TIME)
+
+    async def _followmessages(self):
+        '''Play like the leader, following its messages in order.'''
+        async for message in self._followqueue:
+            try:
+                if message['type'] == 'snapshot':
+                    # Get the full state of the leader
+                    response = await tornado.httpclient.AsyncHTTPClient(
+                        ).fetch(f'{self._leader}/sync')
+                    result = json.loads(response.body)
+                    if result['error']:
+                        raise ValueError(result['errmsg'])
+                    await self._followsync(result['data'])
+                elif message['type'] == 'sync':
+                    del message['type']
+                    await self._followsync(message)
+            except Exception as e:
+                logging.warning(f'cannot follow {self._leader}: {e}')
+
+    async def _followsync(self, sync):
+        '''Play like the leader, given its state.'''
+        self._leadersync = sync
+        if self._player.clock is None:
+            await self._setleaderclock(sync['clockport'])
+        state = sync['state']
+        song = sync['song']
+        if state == 'stop' or song is None:
+            self._followedbasetime = None
+            if self._player.state != 'stop':
+                self._player.stop()
+            return
+
+        # If the leader changed to the next song without gaps, this player
+        # does it too
+        current = self._playlist.current
+        upcoming = self._playlist.upcoming
+        if (state == 'play' and sync['basetime'] == self._followedbasetime
+                and current is not None and current.hash != song['hash']
+                and upcoming is not None and upcoming.hash == song['hash']):
+            return
+        await self._mirror(song, sync['next'])
+        if state == 'play' and sync['basetime'] != self._followedbasetime:
+            self._followedbasetime = sync['basetime']
+            self._player.schedule(self._playlist.current, sync['position'],
+                sync['basetime'])
+        elif state == 'pause':
+            self._followedbasetime = None
+            if self._player.state == 'play':
+                self._player.pause()
+
+    async def _mirror(self, song, upcoming):
+        '''Make the current and the next songs of the playlist the given
+        ones, if they aren't yet.
+        '''
+        current = self._playlist.current
+        if current is None or current.hash != song['hash']:
+            self._playlist.clear()
+            await self._playlist.enqueuehash(song['title'], song['hash'])
+        next_ = self._playlist.upcoming
+        if ((next_.hash if next_ is not None else None)
+                != (upcoming['hash'] if upcoming is not None else None)):
+            while self._playlist.upcoming is not None:
+                self._playlist.remove(self._playlist.currentindex + 1)
+            if upcoming is not None:
+                await self._playlist.enqueuehash(
+                    upcoming['title'], upcoming['hash'])
+        self._updatenext()
+
+    def _publish(self, message, throttled=False):
+        '''Publish a change of state. The changes not throttled increase
+        the version of the status.
+        '''
+        if not throttled:
+            self._version += 1
+            batch = self._batch()
+            if batch is not None:
+                batch.pendingnotify = True
+            else:
+                self._versionchanged.notify_all()
+        self._publisher.publish(message, throttled)
+
+    def _publishplayer(self):
+        '''Publish the status of the player.'''
+        status = self._player.status().serialize()
+        self._publish(dict(type='player', **status))
+
+    def _publishposition(self):
+        '''Publish the position of the current song.'''
+        if len(self._publisher):
+            status = self._player.status().serialize()
+            self._publish(
+                {'type': 'position', 'position': status['position']},
+                throttled=True)
+
+    def _publishsync(self):
+        '''Publish the state of the player for the followers, if it
+        changed.
+        '''
+        if self._timeprovider is None:
+            return
+        sync = self.sync()
+        if sync != self._lastsync:
+            self._lastsync = sync
+            self._publisher.publish({'type': 'sync', **sync})
+
+    def _restore(self, playlist, state, volume):
+        '''Restore the playlist and the player from a snapshot.'''
+        self._playlist.restore(playlist)
+        self._player.setvolume(volume)
+        song = self._playlist.current
+        if state == 'stop' or song is None:
+            self._player.stop()
+        elif state == 'play':
+            self._player.play(song)
+        elif self._player.state == 'play':
+            self._player.pause()
+        self._updatenext()
+
+        # The subscribers get the whole state again
+        self._publisher.resync()
+
+    async def _setleaderclock(self, clockport):
+        '''Make the player use the clock of the leader.'''
+        host = urllib.parse.urlsplit(self._leader).hostname
+        address = await tornado.ioloop.IOLoop.current().run_in_executor(
+            None, socket.gethostbyname, host)
+        clock = GstNet.NetClientClock.new('leader', address, clockport, 0)
+        await tornado.ioloop.IOLoop.current().run_in_executor(
+            None, clock.wait_for_sync, 5 * Gst.SECOND)
+        self._player.setclock(clock, self._syncdelay)
+
+    def _updatenext(self):
+        '''Update the player after a change in the playlist.'''
+        batch = self._batch()
+        if batch is not None:
+            batch.pendingupdatenext = True
+            return
+        self._player.setnext(self._playlist.upcoming)
+        self._playlist.prefetch(self._prefetchwindow, self._prefetchbytes)
+        self._publishsync()
+
+class _Batch:
+    '''A batch of changes executed in a MusicServer, with the work delayed
+    until its end.
+    '''
+
+    def __init__(self, musicserver):
+        self.musicserver = musicserver
+        self.active = True
+        self.pendingnotify = False
+        self.pendingupdatenext = False
+
 class Player:
-    '''Plays songs.'''
+    '''Plays songs.
+
+    If standby is enabled, a second pipeline is kept prerolled in PAUSED on
+    the next song, so that skipping to it only needs a PAUSED to PLAYING
+    transition. The standby pipeline has its own audio sink, and its own
+    encoder for the stream, so it's disabled by default.
+
+    If a clock is set, the pipelines use it, and every time the player starts
+    to play, resumes or seeks, the song is scheduled to start delay seconds
+    later in the clock. Other players with the same clock, even in other
+    hosts, can play in sync with this one scheduling the same songs at the
+    same times. The listener is told about every schedule, pause and stop.
+
+    If a web.LiveStream is given as stream, what the player plays is also
+    encoded, once, to MP3 at the given bitrate, in kbps, and written to it.
+    The encoder is fed through a leaky queue, so it never delays the local
+    output.
+    '''
 
     _STATES = {
         Gst.State.NULL: 'stop',
@@ -359,74 +1557,159 @@ class Player:
         Gst.State.PLAYING: 'play'
     }
 
-    def __init__(self, listener):
+    # Name of the message that marks the end of the messages of a failed song
+    _FAILED_MARK = 'musicserver-failed-mark'
+
+    # Name of the message that marks the end of the messages posted by a
+    # pipeline before it was swapped
+    _SWAP_MARK = 'musicserver-swap-mark'
+
+    def __init__(self, listener, standby=False, stream=None,
+            streambitrate=DEFAULT_STREAM_BITRATE):
         self._state = 'stop'
         self._listener = listener
-        self._closing = False
+        self._stream = stream
+        self._streambitrate = streambitrate
+        self._closing = tornado.locks.Event()
+        self._ioloop = tornado.ioloop.IOLoop.current()
         self._song = None
+        self._uri = None
+        self._next = None
+        self._pending = None
         self._position = None
+        self._clock = None
+        self._delay = None
+        self._scheduled = None
+        self._standbysong = None
+        self._swapped = collections.Counter()
+        self._playstart = None
+        self._skipping = False
+        self._failing = False
+        self._plays = 0
+        self._firstaudio = None
+        self._firstaudiototal = 0.0
+        self._skips = 0
+        self._skiplatency = None
+        self._skiplatencytotal = 0.0
+        self._trackend = None
+        self._gapless = 0
+        self._gaplesslatency = None
+        self._gaplesslatencytotal = 0.0
 
         # Initialize gstreamer
         Gst.init()
 
-        # Build the gstreamer pipeline
-        self._pipeline = Gst.parse_launch("playbin")
+        # Build the gstreamer pipelines
+        self._pipeline = self._create_pipeline()
+        self._standby = self._create_pipeline() if standby else None
+        self._volume = self._pipeline.get_property('volume')
 
     def __del__(self):
-        '''Set the pipeline to NULL to allow neat cleanup of resources.'''
+        '''Set the pipelines to NULL to allow neat cleanup of resources.'''
         try:
             self._pipeline.set_state(Gst.State.NULL)
+            if self._standby is not None:
+                self._standby.set_state(Gst.State.NULL)
         except Exception: pass
 
+    @property
+    def clock(self):
+        '''Return the clock set, if any.'''
+        return self._clock
+
     @property
     def state(self):
         '''Return the playing state of this player.'''
         return self._state
 
+    @property
+    def volume(self):
+        '''Return the playing volume.'''
+        return self._volume
+
     def close(self):
-        '''Close the player.'''
-        self._closing = True
+        '''Close the player. Can be called from any thread.'''
+        self._ioloop.add_callback(self._closing.set)
 
     def pause(self):
         '''Set the player to pause.'''
         if self._state == 'play':
             self._pipeline.set_state(Gst.State.PAUSED)
+            if self._clock is not None:
+                self._listener.playerscheduled('pause', self._song, None, None)
         else:
             raise ValueError('player not in PLAY state')
 
     def play(self, song):
         '''Set the player to play.'''
+        if self._clock is not None:
+            # Resume from the current position, or start the song
+            position = 0.0
+            if self._song is song and self._state == 'pause':
+                self._update_song_attributes()
+                position = self._position or 0.0
+            self.schedule(song, position, self._clocktime())
+            return
+        self._swap(song)
+
         # Set the song to play
-        if self._song != song:
-            self._song = song
-            path = os.path.abspath(song.path)
-            self._pipeline.set_property('uri', f'file://{path}')
+        if self._song is not song or self._state == 'stop':
+            self._playstart = time.monotonic()
+        self._song = song
+        self._seturi(song)
 
         # Set the pipeline to PLAYING state
         self._pipeline.set_state(Gst.State.PLAYING)
 
     async def run(self):
-        '''Run the main loop that plays the songs.'''
-        bus = self._pipeline.get_bus()
-        while not self._closing:
-            msg = bus.pop_filtered(Gst.MessageType.ERROR | Gst.MessageType.EOS
-                | Gst.MessageType.STATE_CHANGED | Gst.MessageType.SEGMENT_DONE)
-
-            # Check the received message
-            if msg:
-                self._handle_message(msg)
-            else:
-                if self._state != 'stop':
-                    # Update song attributes
-                    self._update_song_attributes()
-                else:
-                    self._position = None
+        '''Run the main loop that plays the songs.
 
-                # Wait for a given time
-                await tornado.gen.sleep(DEFAULT_EVENT_WAIT_TIME)
+        The file descriptors of the pipelines' buses are watched by the
+        IOLoop, so the messages are handled as soon as they arrive, without
+        polling.
+        '''
+        pipelines = [p for p in (self._pipeline, self._standby)
+            if p is not None]
+        fds = []
+        for pipeline in pipelines:
+            fd = pipeline.get_bus().get_pollfd().fd
+            handler = functools.partial(self._handle_bus, pipeline)
+            self._ioloop.add_handler(fd, handler, tornado.ioloop.IOLoop.READ)
+            fds.append(fd)
+
+            # Handle the messages posted before watching the bus
+            handler(fd, None)
+        await self._closing.wait()
 
         # Closing the player
-        self._pipeline.set_state(Gst.State.NULL)
+        for fd in fds:
+            self._ioloop.remove_handler(fd)
+        for pipeline in pipelines:
+            pipeline.set_state(Gst.State.NULL)
+
+    def schedule(self, song, position, basetime):
+        '''Play a song from the given position, in seconds, starting at the
+        given time of the clock, in nanoseconds.
+        '''
+        if self._clock is None:
+            raise ValueError('player without clock')
+        self._swap(song)
+        if self._song is not song or self._state == 'stop':
+            self._playstart = time.monotonic()
+        if self._uri != self._songuri(song):
+            self._pipeline.set_state(Gst.State.READY)
+        self._song = song
+        self._seturi(song)
+        self._scheduled = (position, basetime)
+        self._listener.playerscheduled('play', song, position, basetime)
+
+        # The song can be started only when it is prerolled
+        ret, state, pending = self._pipeline.get_state(0)
+        if (ret == Gst.StateChangeReturn.SUCCESS
+                and state in (Gst.State.PAUSED, Gst.State.PLAYING)):
+            self._startscheduled()
+        else:
+            self._pipeline.set_state(Gst.State.PAUSED)
 
     def seek(self, position):
         '''Set the stream position.'''
@@ -434,56 +1717,178 @@ class Player:
             raise ValueError('wrong position value')
 
         # Seek only if the player is not in stop state
+        self._update_song_attributes()
         if self._state != 'stop' and self._song.duration is not None:
-            position = self._song.duration * position
-            self._pipeline.seek_simple(Gst.Format.TIME,
-                Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT,
-                int(position * Gst.SECOND))
+            self._seek(self._song.duration * position)
         else:
             raise ValueError('player stopped')
 
+    def setclock(self, clock, delay):
+        '''Use the given clock, and schedule the songs to start delay
+        seconds later in it.
+        '''
+        self._clock = clock
+        self._delay = delay
+        for pipeline in (self._pipeline, self._standby):
+            if pipeline is not None:
+                # The base time is set when the songs are scheduled
+                pipeline.use_clock(clock)
+                pipeline.set_start_time(Gst.CLOCK_TIME_NONE)
+
+    def setnext(self, song):
+        '''Set the song to play after the current one.
+
+        The song is played without gaps when the current one finishes, and it
+        is prerolled in the standby pipeline, if any.
+        '''
+        self._next = song
+        if self._standby is not None and song is not self._standbysong:
+            self._standbysong = song
+            if song is None:
+                # Release the resources held by the standby pipeline
+                self._standby.set_state(Gst.State.NULL)
+            else:
+                self._standby.set_state(Gst.State.READY)
+                self._standby.set_property('uri', self._songuri(song))
+                self._standby.set_state(Gst.State.PAUSED)
+
     def setvolume(self, volume):
         '''Set the playing volume.'''
         if not 0.0 <= volume <= 1.0:
             raise ValueError('wrong volume')
         self._pipeline.set_property('volume', volume)
+        self._volume = volume
+
+    def skip(self, song):
+        '''Skip to the given song and play it, measuring the time it takes.'''
+        self._skipping = True
+        self.play(song)
 
     def skipbackwards(self):
         '''Move the stream position a fixed amount backwards.'''
+        self._update_song_attributes()
         if (self._state != 'stop' and self._song.duration is not None
                 and self._position is not None):
-            newpos = max(self._position - 10.0, 0.0)
-            self._pipeline.seek_simple(Gst.Format.TIME,
-                Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT,
-                int(newpos * Gst.SECOND))
+            self._seek(max(self._position - 10.0, 0.0))
         else:
             raise ValueError('player stopped')
 
     def skipforwards(self):
         '''Move the stream position a fixed amount forwards.'''
+        self._update_song_attributes()
         if (self._state != 'stop' and self._song.duration is not None
                 and self._position is not None):
-            newpos = min(self._position + 10.0, self._song.duration)
-            self._pipeline.seek_simple(Gst.Format.TIME,
-                Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT,
-                int(newpos * Gst.SECOND))
+            self._seek(min(self._position + 10.0, self._song.duration))
         else:
             raise ValueError('player stopped')
 
+    def stats(self):
+        '''Return the statistics of the player.'''
+        return {
+            'standby': self._standby is not None,
+            'plays': self._plays,
+            'firstaudio': self._firstaudio,
+            'firstaudiomean': (self._firstaudiototal / self._plays
+                if self._plays else None),
+            'skips': self._skips,
+            'skiplatency': self._skiplatency,
+            'skiplatencymean': (self._skiplatencytotal / self._skips
+                if self._skips else None),
+            'gapless': self._gapless,
+            'gaplesslatency': self._gaplesslatency,
+            'gaplesslatencymean': (self._gaplesslatencytotal / self._gapless
+                if self._gapless else None),
+        }
+
     def status(self):
         '''Return the status of the player.'''
-        return PlayerStatus(
-            self._state, self._position, self._pipeline.get_property('volume'))
+        self._update_song_attributes()
+        return PlayerStatus(self._state, self._position, self._volume)
 
     def stop(self):
         '''Stop playing the current song.'''
+        self._pending = None
+        self._scheduled = None
         self._pipeline.set_state(Gst.State.READY)
+        if self._clock is not None:
+            self._listener.playerscheduled('stop', None, None, None)
+        if self._failing:
+            # The messages of the failed song still in the bus come before
+            # this mark, and are ignored
+            self._pipeline.get_bus().post(Gst.Message.new_application(
+                self._pipeline, Gst.Structure.new_empty(self._FAILED_MARK)))
+
+    def _about_to_finish(self, playbin):
+        '''Queue the next song in the running pipeline, so that it starts
+        without gaps. Called from a streaming thread.
+        '''
+        song = self._next
+        if playbin is self._pipeline and song is not None:
+            self._trackend = self._remaining(playbin) + time.monotonic()
+            self._pending = song
+            self._seturi(song, force=True)
+
+    def _clocktime(self):
+        '''Return the time of the clock when the next start is scheduled.'''
+        return self._clock.get_time() + int(self._delay * Gst.SECOND)
+
+    def _create_pipeline(self):
+        '''Build a gstreamer pipeline.'''
+        pipeline = Gst.parse_launch("playbin")
+        pipeline.connect('about-to-finish', self._about_to_finish)
+        if self._stream is not None:
+            pipeline.set_property('audio-sink', self._create_streamsink())
+        return pipeline
+
+    def _create_streamsink(self):
+        '''Build an audio sink that plays the audio and also encodes it for
+        the live stream.
+        '''
+        sink = Gst.parse_bin_from_description(
+            'tee name=tee ! queue ! autoaudiosink '
+            'tee. ! queue leaky=downstream ! audioconvert ! audioresample '
+            '! lamemp3enc target=bitrate cbr=true '
+            f'bitrate={self._streambitrate} '
+            '! appsink name=stream sync=true async=false emit-signals=true',
+            True)
+        sink.get_by_name('stream').connect('new-sample', self._streamsample)
+        return sink
+
+    def _handle_bus(self, pipeline, fd, events):
+        '''Handle all the messages pending in the bus of a pipeline.'''
+        bus = pipeline.get_bus()
+        msg = bus.pop()
+        while msg is not None:
+            name = (msg.get_structure().get_name()
+                if msg.type == Gst.MessageType.APPLICATION else None)
+            if name == self._FAILED_MARK:
+                self._failing = False
+            elif name == self._SWAP_MARK:
+                self._swapped[pipeline] -= 1
+            elif pipeline is self._pipeline:
+                # The messages posted while the pipeline was the standby one
+                # are about prerolling it, but its errors
+                if (not self._swapped[pipeline]
+                        or msg.type == Gst.MessageType.ERROR):
+                    self._handle_message(msg)
+            elif self._swapped[pipeline]:
+                # The messages of the song played before the swap
+                pass
+            elif msg.type == Gst.MessageType.ERROR:
+                # The standby song can't be prerolled, it will be played in
+                # the main pipeline
+                self._standbysong = None
+                pipeline.set_state(Gst.State.NULL)
+            msg = bus.pop()
 
     def _handle_message(self, msg):
         '''Process the message received.'''
         if msg.type == Gst.MessageType.ERROR:
-            # An error was received
-            self._listener.playererror(msg)
+            # An error was received, only the first one of each song is
+            # reported
+            if not self._failing:
+                self._failing = True
+                self._listener.playererror(self._song, msg)
         elif msg.type in [Gst.MessageType.EOS, Gst.MessageType.SEGMENT_DONE]:
             # The song has arrived to the end
             self._listener.playereos()
@@ -491,17 +1896,144 @@ class Player:
             if msg.src == self._pipeline:
                 # The state has changed
                 oldstate, newstate, pending = msg.parse_state_changed()
-                self._state = self._STATES[newstate]
-                if self._state == 'stop':
-                    self._position = None
+                state = self._STATES[newstate]
+                changed = state != self._state
+                self._state = state
+                self._update_song_attributes()
+                if changed:
+                    self._listener.playerstatechanged(state)
+                if self._state == 'play' and self._playstart is not None:
+                    self._started()
+                if (newstate == Gst.State.PAUSED
+                        and pending == Gst.State.VOID_PENDING
+                        and self._scheduled is not None):
+                    self._startscheduled()
+        elif msg.type == Gst.MessageType.DURATION_CHANGED:
+            self._update_song_attributes()
+        elif msg.type == Gst.MessageType.STREAM_START:
+            # If the song queued by about-to-finish started, it's the current
+            # song now
+            song = self._pending
+            if song is not None:
+                self._pending = None
+                self._song = song
+                self._trackchanged()
+                self._listener.playertrackchanged(song)
+
+    @staticmethod
+    def _remaining(playbin):
+        '''Return the seconds left to play of the song in a pipeline, or 0 if
+        unknown.
+        '''
+        res, duration = playbin.query_duration(Gst.Format.TIME)
+        if not res:
+            return 0.0
+        res, position = playbin.query_position(Gst.Format.TIME)
+        if not res:
+            return 0.0
+        return max(duration - position, 0) / Gst.SECOND
+
+    def _seek(self, position):
+        '''Seek the current song to the given position, in seconds.'''
+        if self._clock is not None:
+            self.schedule(self._song, position, self._clocktime())
+        else:
+            self._pipeline.seek_simple(Gst.Format.TIME,
+                Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT,
+                int(position * Gst.SECOND))
+
+    def _seturi(self, song, force=False):
+        '''Set the uri of the pipeline to the given song, if not set yet.'''
+        uri = self._songuri(song)
+        if force or self._uri != uri:
+            self._uri = uri
+            self._pipeline.set_property('uri', uri)
+
+    def _started(self):
+        '''Record the time taken by the last song to start playing since
+        it was played.
+        '''
+        latency = time.monotonic() - self._playstart
+        self._playstart = None
+        self._firstaudio = latency
+        self._plays += 1
+        self._listener.playerstarted(self._song)
+        self._firstaudiototal += latency
+        if self._skipping:
+            self._skipping = False
+            self._skiplatency = latency
+            self._skips += 1
+            self._skiplatencytotal += latency
+
+    def _startscheduled(self):
+        '''Start the scheduled song, once prerolled.'''
+        position, basetime = self._scheduled
+        self._scheduled = None
+
+        # After a flushing seek the running time starts again from 0, that
+        # is reached in the base time
+        self._pipeline.seek_simple(Gst.Format.TIME,
+            Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE,
+            int(position * Gst.SECOND))
+        self._pipeline.set_base_time(basetime)
+        self._pipeline.set_state(Gst.State.PLAYING)
+
+    @staticmethod
+    def _songuri(song):
+        '''Return the uri of a song.'''
+        return f'file://{os.path.abspath(song.path)}'
+
+    def _streamsample(self, appsink):
+        '''Write an encoded buffer to the live stream. Called from a
+        streaming thread.
+        '''
+        buffer = appsink.emit('pull-sample').get_buffer()
+        data = buffer.extract_dup(0, buffer.get_size())
+        self._ioloop.add_callback(self._stream.write, data)
+        return Gst.FlowReturn.OK
+
+    def _swap(self, song):
+        '''Swap the main pipeline and the standby one, if the given song is
+        prerolled in the standby one.
+
+        The messages already posted by both pipelines are marked, so that
+        they are not taken as posted by the other one.
+        '''
+        if self._standbysong is None or self._standbysong is not song:
+            return
+        old = self._pipeline
+        old.set_state(Gst.State.READY)
+        self._standby.set_property('volume', self._volume)
+        self._pipeline, self._standby = self._standby, old
+        self._uri = self._songuri(self._standbysong)
+        self._standbysong = None
+        for pipeline in (self._pipeline, self._standby):
+            self._swapped[pipeline] += 1
+            pipeline.get_bus().post(Gst.Message.new_application(
+                pipeline, Gst.Structure.new_empty(self._SWAP_MARK)))
+
+    def _trackchanged(self):
+        '''Record the time taken by the song queued by about-to-finish to
+        start, since the end of the previous one.
+        '''
+        latency = max(time.monotonic() - self._trackend, 0.0)
+        self._trackend = None
+        self._gaplesslatency = latency
+        self._gapless += 1
+        self._gaplesslatencytotal += latency
 
     def _update_song_attributes(self):
         '''Update the current song attributes, as duration and position.'''
+        if self._state == 'stop':
+            self._position = None
+            return
+
         if self._song.duration is None:
             # Query the song's duration
             res, duration = self._pipeline.query_duration(Gst.Format.TIME)
             if res:
                 self._song.setduration(duration / 1000000000)
+                self._listener.playerdurationchanged(self._song)
 
         # Query the song's position
         res, position = self._pipeline.query_position(Gst.Format.TIME)
@@ -522,28 +2054,53 @@ class PlayerStatus:
             'volume': self._volume}
 
 class Playlist:
-    '''Keeps a queue of songs to play.'''
-
-    def __init__(self, songdir, size=10):
-        self._queue = collections.deque()
-        self._refcount = {}
-        self._songdir = songdir
+    '''Keeps a queue of songs to play.
+
+    The song files are kept in a SongStore, that counts the references to each
+    one of them from the playlist.
+
+    The listener, if given, is told about every change in the playlist with a
+    dictionary that describes it.
+
+    Each song gets an id that identifies it while it is in the playlist. The
+    songs are kept in an IndexedList, so they can be inserted, moved and
+    removed anywhere in O(log n) time. The digests and the titles of the songs
+    are interned, so the songs enqueued many times share them, and the ids of
+    the songs with each digest are indexed.
+
+    The metadata of the songs is discovered in the background when they are
+    enqueued, and the listener is told when it is known.
+
+    The songs are serialized to json once for every digest and title, and
+    serialized again only when their metadata changes.
+    '''
+
+    def __init__(self, store, size=10, listener=None):
+        self._queue = indexedlist.IndexedList()
+        self._songs = {}
+        self._digests = {}
+        self._encoded = {}
+        self._discovering = set()
+        self._ids = itertools.count(1)
+        self._store = store
         self._size = size
         self._current = 0
-
-        # Create the directory if it doesn't exist
-        if not os.path.exists(self._songdir):
-            os.mkdir(self._songdir)
-
-        # Clear old songs
-        self._clear_all_songs()
+        self._listener = listener
 
     def clear(self):
         '''Remove all songs in the playlist.'''
+        for song in self._queue:
+            self._store.release(song.hash)
         self._queue.clear()
-        self._refcount = {}
-        self._clear_all_songs()
+        self._songs = {}
+        self._digests = {}
+        self._encoded = {}
         self._current = 0
+        self._notify({'type': 'clear'})
+
+    def close(self):
+        '''Close the playlist, finishing the pending disk operations.'''
+        self._store.close()
 
     @property
     def current(self):
@@ -559,27 +2116,92 @@ class Playlist:
             return None
         return self._current
 
-    def enqueue(self, title, data):
+    @property
+    def upcoming(self):
+        '''Return the song after the current one in the playlist.'''
+        if self._current + 1 > len(self._queue) - 1:
+            return None
+        return self._queue[self._current + 1]
+
+    def durationchanged(self, song):
+        '''Record that the duration of a song was learnt while playing it.'''
+        self._encoded.pop(song.digest, None)
+
+    def discard(self, snapshot):
+        '''Discard a snapshot of the playlist that won't be restored.'''
+        songs, _ = snapshot
+        for song in songs:
+            self._store.release(song.hash)
+
+    def encodedstatus(self):
+        '''Return the status of the whole playlist serialized as json.'''
+        songs = b', '.join(self._encodesong(s) for s in self._queue)
+        tail = json.dumps({'current': self.currentindex, 'offset': 0,
+            'total': len(self._queue)}).encode('utf-8')
+        return b''.join((b'{"songs": [', songs, b'], ', tail[1:]))
+
+    async def enqueue(self, title, data):
         '''Enqueue a song in the playlist.'''
-        # Compute the hash of the song
-        hash_ = self._hash(data)
-
-        # Save the song to disk if necessary
+        hash_ = await self._store.store(data)
+        self._append(title, hash_)
+
+    async def enqueuehash(self, title, hash_):
+        '''Enqueue a song already stored, given its hash.'''
+        if not await self._store.acquire(hash_):
+            raise ValueError('song not stored')
+        self._append(title, hash_)
+
+    async def enqueueupload(self, title, upload):
+        '''Enqueue a song received with an upload.'''
+        hash_ = await self._store.storeupload(upload)
+        self._append(title, hash_)
+
+    def failed(self, song):
+        '''Record that a song failed to play.'''
+        self._store.failed(song.hash)
+
+    def has(self, hashes):
+        '''Return the hashes, from the given ones, of the songs stored.'''
+        return self._store.has(hashes)
+
+    def indexof(self, id_):
+        '''Return the index of the song with the given id.'''
         try:
-            self._refcount[hash_] += 1
+            return self._queue.index(self._songs[id_])
         except KeyError:
-            self._save(data, hash_)
-            self._refcount[hash_] = 1
+            raise ValueError('unknown song id')
 
-        # Instantiate a Song
-        path = os.path.join(self._songdir, hash_)
-        s = Song(title, path, hash_)
+    async def insert(self, index, title, hash_):
+        '''Insert a song already stored, given its hash, before the given
+        index.
+        '''
+        if index < 0:
+            raise ValueError('index must be non-negative')
+        if not await self._store.acquire(hash_):
+            raise ValueError('song not stored')
+        self._insert(index, title, hash_)
+
+    def move(self, src, dst):
+        '''Move the song at index src to index dst.'''
+        if not (0 <= src < len(self._queue) and 0 <= dst < len(self._queue)):
+            raise IndexError('wrong index')
+        self._queue.move(src, dst)
+        self._notify({'type': 'move', 'src': src, 'dst': dst})
+
+        # Adjust the current index, the current song doesn't change
+        oldcurrent = self._current
+        if src == self._current:
+            self._current = dst
+        elif src < self._current <= dst:
+            self._current -= 1
+        elif dst <= self._current < src:
+            self._current += 1
+        if self._current != oldcurrent:
+            self._notifycurrent()
 
-        # Add the song to the playlist
-        self._queue.append(s)
-
-        # Remove old songs from the playlist
-        self._remove_songs()
+    def newupload(self):
+        '''Return a new upload to receive a song in chunks.'''
+        return self._store.newupload()
 
     def next(self):
         '''Go to the next song.'''
@@ -590,6 +2212,18 @@ class Playlist:
 
         # Remove old songs from the playlist
         self._remove_songs()
+        self._notifycurrent()
+
+    def played(self, song):
+        '''Record that a song was played.'''
+        self._store.played(song.hash)
+
+    def prefetch(self, window, maxbytes=None):
+        '''Read ahead from disk the current song and the given number of
+        songs after it, up to maxbytes.
+        '''
+        songs = itertools.islice(self._queue.iterfrom(self._current), window + 1)
+        self._store.prefetch(self, [s.hash for s in songs], maxbytes)
 
     def prev(self):
         '''Go to the previous song.'''
@@ -597,6 +2231,7 @@ class Playlist:
         if newindex < 0:
             raise IndexError('no more songs')
         self._current = newindex
+        self._notifycurrent()
 
     def remove(self, index):
         '''Remove the song with the given index from the playlist.'''
@@ -608,100 +2243,1056 @@ class Playlist:
         song = self._queue[index]
 
         # Update the refcount for this song
-        self._remove_refcount(song)
+        self._store.release(song.hash)
+        self._releasedigest(song.digest, song.id)
 
         # Remove the song from the queue
         del self._queue[index]
+        del self._songs[song.id]
+        self._notify({'type': 'remove', 'index': index, 'count': 1})
 
         # Adjust the current index
+        oldcurrent = self._current
         if index < self._current:
             self._current -= 1
         self._current = max(min(self._current, len(self._queue) - 1), 0)
+        if self._current != oldcurrent or not self._queue:
+            self._notifycurrent()
+
+    def restore(self, snapshot):
+        '''Restore the playlist from a snapshot.'''
+        for song in self._queue:
+            self._store.release(song.hash)
+
+        # The references to the songs kept by the snapshot are the ones of
+        # the playlist now
+        songs, self._current = snapshot
+        self._queue = indexedlist.IndexedList(songs)
+        self._songs = {s.id: s for s in songs}
+        self._digests = {}
+        self._encoded = {}
+        for song in songs:
+            song.digest = self._acquiredigest(song.hash, song.id)
+        self._notify({'type': 'reset'})
+
+    async def seed(self, peer=None):
+        '''Fetch the songs stored in the given peer, or in all the peers,
+        that are not stored. Return their hashes.
+        '''
+        return await self._store.seed(peer)
 
-    def status(self):
-        '''Return the status of the playlist.'''
-        return PlaylistStatus(self._queue, self.currentindex)
+    def snapshot(self):
+        '''Return a snapshot of the playlist, that can be restored later.
+        The snapshot keeps a reference to its songs until it is restored or
+        discarded.
+        '''
+        songs = list(self._queue)
+        for song in songs:
+            self._store.retain(song.hash)
+        return songs, self._current
+
+    def songs(self):
+        '''Return the hashes of all the songs stored.'''
+        return self._store.songs()
+
+    def status(self, offset=0, limit=None, fields=None):
+        '''Return the status of the playlist, with the songs from offset, up
+        to limit songs, and only the given fields of them.
+        '''
+        if offset == 0 and limit is None:
+            songs = self._queue
+        else:
+            songs = itertools.islice(self._queue.iterfrom(offset), limit)
+        return PlaylistStatus(
+            songs, self.currentindex, offset, len(self._queue), fields)
 
-    def _clear_all_songs(self):
-        '''Remove all the songs from the directory.'''
-        for x in os.listdir(self._songdir):
-            os.unlink(os.path.join(self._songdir, x))
+    def totals(self):
+        '''Return the number of songs and their total duration, of the songs
+        whose duration is known.
+        '''
+        duration = sum(s.duration for s in self._queue
+            if s.duration is not None)
+        return len(self._queue), duration
 
-    def _hash(self, data):
-        '''Compute the hash of the given data.'''
-        m = hashlib.sha256()
-        m.update(data)
-        return m.hexdigest()
+    def _acquiredigest(self, hash_, id_):
+        '''Return the digest of the given hash, shared by all the songs with
+        the same hash, and index the id of the song with it.
+        '''
+        digest = bytes.fromhex(hash_)
+        try:
+            digest, ids = self._digests[digest]
+        except KeyError:
+            ids = set()
+            self._digests[digest] = (digest, ids)
+        ids.add(id_)
+        return digest
+
+    def _append(self, title, hash_):
+        '''Append the song with the given hash to the playlist.'''
+        self._insert(len(self._queue), title, hash_)
+
+    def _discover(self, hash_):
+        '''Discover the metadata of a song in the background, and tell the
+        listener about it.
+        '''
+        if hash_ in self._discovering or self._store.discovered(hash_):
+            return
+        self._discovering.add(hash_)
+        async def discover():
+            try:
+                metadata = await self._store.discover(hash_)
+            finally:
+                self._discovering.discard(hash_)
+            digest = bytes.fromhex(hash_)
+            self._encoded.pop(digest, None)
+            ids = sorted(self._digests.get(digest, (digest, ()))[1])
+            if ids:
+                change = {'type': 'metadata', 'ids': ids}
+                change.update(metadata.todict())
+                self._notify(change)
+        tornado.ioloop.IOLoop.current().spawn_callback(discover)
+
+    def _encodesong(self, song):
+        '''Return a song serialized as json. All but its id is serialized
+        once for every digest and title.
+        '''
+        try:
+            titles = self._encoded[song.digest]
+        except KeyError:
+            titles = self._encoded[song.digest] = {}
+        try:
+            encoded = titles[song.title]
+        except KeyError:
+            d = song.todict()
+            del d['id']
+            encoded = titles[song.title] = json.dumps(d).encode('utf-8')[1:]
+        return b'{"id": %d, %s' % (song.id, encoded)
+
+    def _insert(self, index, title, hash_):
+        '''Insert the song with the given hash before the given index.'''
+        # Instantiate a Song
+        index = min(index, len(self._queue))
+        title = self._store.addtitle(hash_, sys.intern(title))
+        id_ = next(self._ids)
+        s = Song(title, self._acquiredigest(hash_, id_), self._store, id_)
+
+        # Add the song to the playlist
+        self._queue.insert(index, s)
+        self._songs[s.id] = s
+        self._notify({'type': 'insert', 'index': index, 'song': s.todict()})
+        if len(self._queue) == 1:
+            self._notifycurrent()
+        elif index <= self._current:
+            # The current song has moved forwards
+            self._current += 1
+            self._notifycurrent()
+
+        # Remove old songs from the playlist
+        if self._remove_songs():
+            self._notifycurrent()
+
+        # Discover the metadata of the song if it's not known
+        self._discover(hash_)
+
+    def _notify(self, change):
+        '''Tell the listener about a change in the playlist.'''
+        if self._listener is not None:
+            self._listener.playlistchanged(change)
+
+    def _notifycurrent(self):
+        '''Tell the listener that the current song has changed.'''
+        self._notify({'type': 'current', 'current': self.currentindex})
+
+    def _releasedigest(self, digest, id_):
+        '''Remove the id of a song from the index of its digest, forgetting
+        the digest when no song has it anymore.
+        '''
+        ids = self._digests[digest][1]
+        ids.discard(id_)
+        if not ids:
+            del self._digests[digest]
+            self._encoded.pop(digest, None)
 
     def _remove_songs(self):
         '''Remove old songs from the playlist to leave only one less that the
-        maximum capacity.
+        maximum capacity. Return the number of songs removed.
         '''
         # Compute the number of elements to remove
         to_remove = min(self._current, max(0, len(self._queue) - self._size))
+        if not to_remove:
+            return 0
 
         # Remove songs
         for _ in range(to_remove):
-            song = self._queue.popleft()
+            song = self._queue.pop(0)
+            del self._songs[song.id]
 
             # Reduce the counts for this song
-            self._remove_refcount(song)
+            self._store.release(song.hash)
+            self._releasedigest(song.digest, song.id)
 
         # Update the current pointer
         self._current -= to_remove
-
-    def _remove_refcount(self, song):
-        '''Update the refcount of a given song as if it were going to be
-        deleted. Delete the song file if the refcount gets to 0.
-        '''
-        # Reduce the counts for this song
-        newrefcount = self._refcount[song.hash] - 1
-        if newrefcount == 0:
-            # The song is not used anymore, remove it from the directory
-            os.unlink(song.path)
-            del self._refcount[song.hash]
-        else:
-            # The song is still used, update the refcoung
-            self._refcount[song.hash] = newrefcount
-
-    def _save(self, data, name):
-        '''Save the given song to the songs directory.'''
-        with open(os.path.join(self._songdir, name), 'wb') as f:
-            f.write(data)
+        self._notify({'type': 'remove', 'index': 0, 'count': to_remove})
+        return to_remove
 
 class PlaylistStatus:
     '''Stores the status of the playlist.'''
 
-    def __init__(self, songs, current):
+    def __init__(self, songs, current, offset=0, total=None, fields=None):
         self._songs = songs
         self._current = current
+        self._offset = offset
+        self._total = total
+        self._fields = fields
 
     def serialize(self):
         '''Serialize this object.'''
+        if self._fields is None:
+            songs = [s.todict() for s in self._songs]
+        else:
+            songs = []
+            for s in self._songs:
+                d = s.todict()
+                songs.append({f: d[f] for f in self._fields if f in d})
         return {
-            'songs': [s.todict() for s in self._songs],
-            'current': self._current
+            'songs': songs,
+            'current': self._current,
+            'offset': self._offset,
+            'total': self._total
         }
 
 class Song:
-    '''Represents a song.'''
+    '''Represents a song.
+
+    A playlist may hold many songs, so they are kept compact: the hash is kept
+    as the raw sha256 digest, shared by the songs with the same hash, and the
+    path of the file is derived from it on demand. The metadata is shared by
+    all the songs with the same hash too.
+    '''
 
-    def __init__(self, title, path, hash_):
+    __slots__ = ('id', 'title', 'digest', 'metadata', '_store')
+
+    def __init__(self, title, digest, store, id_=None):
+        self.id = id_
         self.title = title
-        self.path = path
-        self.hash = hash_
-        self._duration = None
+        self.digest = digest
+        self._store = store
+        self.metadata = store.metadata(self.hash)
 
     @property
     def duration(self):
         '''Return the duration of this song.'''
-        return self._duration
+        return self.metadata.duration
+
+    @property
+    def hash(self):
+        '''Return the hash of this song, in hexadecimal.'''
+        return self.digest.hex()
+
+    @property
+    def path(self):
+        '''Return the path of the file of this song.'''
+        return self._store.path(self.hash)
 
     def setduration(self, duration):
         '''Set the duration of this song.'''
-        self._duration = duration
+        self.metadata.duration = duration
 
     def todict(self):
         '''Return a dictionary with the data of this song.'''
-        return {'title': self.title, 'duration': self.duration}
+        d = {'id': self.id, 'title': self.title}
+        d.update(self.metadata.todict())
+        return d
+
+class SongDiscoverer:
+    '''Discovers the metadata of song files in a pool of worker threads.
+
+    Each worker thread has its own GstPbutils.Discoverer, used synchronously.
+    '''
+
+    def __init__(self, workers=2, timeout=DEFAULT_DISCOVER_TIMEOUT):
+        self._timeout = int(timeout * Gst.SECOND)
+        self._local = threading.local()
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers)
+
+    def close(self):
+        '''Close the discoverer, abandoning the pending discoveries.'''
+        self._executor.shutdown(wait=False)
+
+    async def discover(self, path):
+        '''Return a dictionary with the metadata of the given file, or None
+        if it can't be decoded. Raise OSError if it can't be discovered now,
+        as when the discovery times out or the file can't be read.
+        '''
+        return await tornado.ioloop.IOLoop.current().run_in_executor(
+            self._executor, self._discover, path)
+
+    def _discover(self, path):
+        '''Discover the metadata of a file, in a worker thread.'''
+        try:
+            discoverer = self._local.discoverer
+        except AttributeError:
+            discoverer = GstPbutils.Discoverer.new(self._timeout)
+            self._local.discoverer = discoverer
+        try:
+            info = discoverer.discover_uri(f'file://{os.path.abspath(path)}')
+        except GLib.Error as e:
+            # Only the errors of the stream, or the lack of plugins to decode
+            # it, mean that the file can't be decoded. The others, as the
+            # errors reading it, may not happen again
+            if not (e.matches(Gst.stream_error_quark(), e.code)
+                    or e.matches(Gst.core_error_quark(),
+                        Gst.CoreError.MISSING_PLUGIN)):
+                raise OSError(f'cannot discover {path}: {e.message}')
+            logging.warning(f'cannot discover {path}: {e.message}')
+            return None
+        result = info.get_result()
+        if result == GstPbutils.DiscovererResult.MISSING_PLUGINS:
+            logging.warning(f'cannot discover {path}: missing plugins')
+            return None
+        if result != GstPbutils.DiscovererResult.OK:
+            raise OSError(f'cannot discover {path}: {result.value_nick}')
+
+        streams = info.get_audio_streams()
+        if not streams:
+            logging.warning(f'cannot discover {path}: no audio streams')
+            return None
+
+        metadata = {}
+        duration = info.get_duration()
+        if duration != Gst.CLOCK_TIME_NONE:
+            metadata['duration'] = duration / Gst.SECOND
+        stream = streams[0]
+        caps = stream.get_caps()
+        if caps is not None:
+            metadata['codec'] = \
+                GstPbutils.pb_utils_get_codec_description(caps)
+        metadata['bitrate'] = \
+            stream.get_bitrate() or stream.get_max_bitrate() or None
+        metadata['channels'] = stream.get_channels() or None
+        tags = info.get_tags()
+        if tags is not None:
+            metadata['tags'] = self._tagstodict(tags)
+        return metadata
+
+    @staticmethod
+    def _tagstodict(tags):
+        '''Return the tags that can be serialized in a dictionary.'''
+        d = {}
+        for i in range(tags.n_tags()):
+            name = tags.nth_tag_name(i)
+            value = tags.get_value_index(name, 0)
+            if isinstance(value, (str, int, float)):
+                d[name] = value
+        return d
+
+class SongFetcher:
+    '''Fetches the songs from other music servers, the peers, given the URLs
+    of their web services.
+
+    The songs are downloaded with the HTTP client, that keeps the connections
+    to the peers open between downloads, and written to an upload in chunks
+    as they arrive, so they are hashed while they are downloaded. A download
+    interrupted is resumed from the next peer with a Range request. The
+    songs bigger than maxsize bytes are not downloaded. A download is
+    abandoned if it doesn't progress in stalltimeout seconds.
+    '''
+
+    def __init__(self, peers, maxsize=None,
+            stalltimeout=DEFAULT_FETCH_STALL_TIMEOUT):
+        self._peers = peers
+        self._maxsize = maxsize
+        self._stalltimeout = stalltimeout
+
+    @property
+    def peers(self):
+        '''Return the URLs of the web services of the peers.'''
+        return self._peers
+
+    async def fetch(self, hash_, upload):
+        '''Download a song into an upload. Return False if no peer has the
+        whole song.
+        '''
+        for peer in self._peers:
+            try:
+                if await self._fetch(peer, hash_, upload):
+                    return True
+            except (OSError, ValueError, tornado.httpclient.HTTPError) as e:
+                logging.warning(f'cannot fetch song {hash_} from {peer}: {e}')
+        return False
+
+    async def index(self, peer):
+        '''Return the hashes of the songs stored in a peer.'''
+        client = tornado.httpclient.AsyncHTTPClient()
+        try:
+            response = await client.fetch(f'{peer}/songs')
+        except (OSError, tornado.httpclient.HTTPError) as e:
+            raise ValueError(f'cannot get the songs of {peer}: {e}')
+        result = json.loads(response.body)
+        if result['error']:
+            raise ValueError(result['errmsg'])
+        return result['data']
+
+    async def _fetch(self, peer, hash_, upload):
+        '''Download a song, or the rest of it, from a peer. Return whether
+        the download was completed.
+        '''
+        headers = {}
+        expected = 200
+        if upload.size:
+            headers['Range'] = f'bytes={upload.size}-'
+            expected = 206
+
+        # Write only the body of the expected response, and only while it
+        # fits. The chunks are written in order by another task
+        accepted = False
+        toobig = False
+        size = upload.size
+        chunks = tornado.queues.Queue()
+        def headerreceived(line):
+            nonlocal accepted
+            if line.startswith('HTTP/'):
+                accepted = int(line.split()[1]) == expected
+        def received(chunk):
+            nonlocal accepted, toobig, size
+            if not accepted:
+                return
+            size += len(chunk)
+            if self._maxsize is not None and size > self._maxsize:
+                accepted = False
+                toobig = True
+            else:
+                chunks.put_nowait(chunk)
+        def preparecurl(curl):
+            curl.setopt(pycurl.LOW_SPEED_LIMIT, 1)
+            curl.setopt(pycurl.LOW_SPEED_TIME, int(self._stalltimeout))
+        writer = asyncio.ensure_future(self._write(chunks, upload))
+        try:
+            response = await tornado.httpclient.AsyncHTTPClient().fetch(
+                f'{peer}/songs/{hash_}', headers=headers,
+                header_callback=headerreceived, streaming_callback=received,
+                prepare_curl_callback=preparecurl, request_timeout=0,
+                raise_error=False)
+        finally:
+            chunks.put_nowait(None)
+            await writer
+        if toobig:
+            raise ValueError('song too big')
+        return accepted and response.error is None
+
+    @staticmethod
+    async def _write(chunks, upload):
+        '''Write the chunks to an upload until None is received, joining the
+        ones received while writing.
+        '''
+        while True:
+            data = [await chunks.get()]
+            while chunks.qsize():
+                data.append(chunks.get_nowait())
+            finished = data[-1] is None
+            if finished:
+                data.pop()
+            if data:
+                await upload.write(b''.join(data))
+            if finished:
+                return
+
+class SongMetadata:
+    '''The metadata of a song file, shared by all the songs with the same
+    hash.
+
+    Besides the metadata discovered from the file, it keeps the titles the
+    song was enqueued with, when it was first seen, when it was last played
+    and how many times, and how many times it failed to play.
+    '''
+
+    __slots__ = ('discovered', 'decodable', 'duration', 'codec', 'bitrate',
+        'channels', 'tags', 'titles', 'firstseen', 'lastplayed', 'plays',
+        'failures')
+
+    def __init__(self):
+        self.discovered = False
+        self.decodable = True
+        self.duration = None
+        self.codec = None
+        self.bitrate = None
+        self.channels = None
+        self.tags = None
+        self.titles = []
+        self.firstseen = None
+        self.lastplayed = None
+        self.plays = 0
+        self.failures = 0
+
+    def todict(self):
+        '''Return a dictionary with the metadata discovered.'''
+        return {'duration': self.duration, 'codec': self.codec,
+            'bitrate': self.bitrate, 'channels': self.channels,
+            'tags': self.tags}
+
+    def update(self, metadata):
+        '''Update the metadata from a dictionary.'''
+        for name, value in metadata.items():
+            setattr(self, name, value)
+
+class SongStore:
+    '''Stores the song files in a directory, named by their sha256 hash.
+
+    The store counts the references to each song. The songs that are not
+    referenced anymore are kept in the directory as a cache, so that enqueuing
+    them again costs nothing, until the size or the number of files in the
+    directory exceed the given budget. Then, the least recently used ones are
+    removed. The cache survives restarts: its index is rebuilt from the
+    directory at startup.
+
+    The operations that hash the songs or touch the disk are run in a pool of
+    worker threads, so they never block the IOLoop. The operations on the same
+    hash are serialized, so concurrent stores of the same song write it only
+    once.
+
+    The metadata of the songs stored is discovered with the given
+    SongDiscoverer, once per song, and kept in the given MetadataStore, or
+    only in memory if none is given.
+
+    The songs not stored are fetched from other music servers with the given
+    SongFetcher, if any, when they are acquired.
+    '''
+
+    # The number of titles remembered for each song
+    MAX_TITLES = 16
+
+    def __init__(self, songdir, workers=2, maxsize=None, maxcount=None,
+            discoverer=None, metadata=None, fetcher=None):
+        self._songdir = songdir
+        self._maxsize = maxsize
+        self._maxcount = maxcount
+        self._discoverer = discoverer
+        self._fetcher = fetcher
+        self._metadata = metadata if metadata is not None else MetadataStore()
+        self._refcount = {}
+        self._sizes = {}
+        self._discoveries = {}
+        self._size = 0
+        self._cached = collections.OrderedDict()
+        self._locks = {}
+        self._prefetched = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers)
+
+        # Create the directory if it doesn't exist
+        if not os.path.exists(self._songdir):
+            os.mkdir(self._songdir)
+
+        # Rebuild the index of the songs cached in the directory
+        self._load()
+
+    @property
+    def executor(self):
+        '''Return the pool of worker threads that touch the disk.'''
+        return self._executor
+
+    @property
+    def songdir(self):
+        '''Return the directory where the songs are stored.'''
+        return self._songdir
+
+    async def acquire(self, hash_):
+        '''Add a reference to a stored song, fetching it from the other music
+        servers if it's not stored. Return False if the song is not stored
+        and can't be fetched.
+        '''
+        async with self._lockhash(hash_):
+            if self._acquire(hash_):
+                return True
+            if self._fetcher is None or not self._ishash(hash_):
+                return False
+            return await self._fetch(hash_)
+
+    def addtitle(self, hash_, title):
+        '''Remember a title a song was enqueued with. Return the title
+        remembered, that is shared by all the songs enqueued with it. Only
+        the last MAX_TITLES titles of a song are remembered.
+        '''
+        titles = self.metadata(hash_).titles
+        try:
+            return titles[titles.index(title)]
+        except ValueError:
+            titles.append(title)
+            del titles[:-self.MAX_TITLES]
+            self._metadata.save(hash_)
+            return title
+
+    def close(self):
+        '''Close the store, finishing the pending disk operations.'''
+        self._executor.shutdown(wait=True)
+        if self._discoverer is not None:
+            self._discoverer.close()
+        self._metadata.close()
+
+    async def discover(self, hash_):
+        '''Discover the metadata of a stored song, if it wasn't discovered
+        before. Return its metadata.
+        '''
+        if not self.discovered(hash_):
+            try:
+                discovery = self._discoveries[hash_]
+            except KeyError:
+                discovery = asyncio.ensure_future(self._discover(hash_))
+                self._discoveries[hash_] = discovery
+            await asyncio.shield(discovery)
+        return self.metadata(hash_)
+
+    def discovered(self, hash_):
+        '''Return whether the metadata of a song was already discovered.'''
+        return self.metadata(hash_).discovered
+
+    def failed(self, hash_):
+        '''Record that a song failed to play.'''
+        self.metadata(hash_).failures += 1
+        self._metadata.save(hash_)
+
+    def has(self, hashes):
+        '''Return the hashes, from the given ones, of the songs stored.'''
+        return [h for h in hashes if h in self._sizes]
+
+    def metadata(self, hash_):
+        '''Return the metadata of a stored song.'''
+        return self._metadata.get(hash_)
+
+    def newupload(self):
+        '''Return a new upload to receive a song in chunks.'''
+        return SongUpload(self._songdir, self._executor)
+
+    def path(self, hash_):
+        '''Return the path of the file of a song.'''
+        return os.path.join(self._songdir, hash_)
+
+    def played(self, hash_):
+        '''Record that a song was played.'''
+        metadata = self.metadata(hash_)
+        metadata.plays += 1
+        metadata.lastplayed = time.time()
+        self._metadata.save(hash_)
+
+    def prefetch(self, owner, hashes, maxbytes=None):
+        '''Ask the system to read ahead the files of the given songs, in
+        order, up to maxbytes.
+
+        Each owner, as the playlist of a zone, has its own window of songs
+        prefetched, that replaces its previous one. The songs that are not in
+        the window of any owner anymore are dropped from the system's page
+        cache.
+        '''
+        window = set()
+        total = 0
+        for hash_ in hashes:
+            if hash_ in window or hash_ not in self._sizes:
+                continue
+            total += self._sizes[hash_]
+            if maxbytes is not None and window and total > maxbytes:
+                break
+            window.add(hash_)
+        before = set().union(*self._prefetched.values())
+        self._prefetched[owner] = window
+        after = set().union(*self._prefetched.values())
+        for hash_ in after - before:
+            self._executor.submit(
+                self._advise, self.path(hash_), _FADV_WILLNEED)
+        for hash_ in before - after:
+            if hash_ in self._sizes:
+                self._executor.submit(
+                    self._advise, self.path(hash_), _FADV_DONTNEED)
+
+    def release(self, hash_):
+        '''Remove a reference to a song. When a song is not referenced
+        anymore, it is kept in the cache.
+        '''
+        newrefcount = self._refcount[hash_] - 1
+        if newrefcount == 0:
+            # The song is not used anymore, keep it as the most recently used
+            # one in the cache
+            del self._refcount[hash_]
+            self._cached[hash_] = None
+            self._executor.submit(self._touch, self.path(hash_))
+            self._evict()
+        else:
+            self._refcount[hash_] = newrefcount
+
+    def retain(self, hash_):
+        '''Add a reference to a song already referenced.'''
+        self._refcount[hash_] += 1
+
+    async def seed(self, peer=None):
+        '''Fetch the songs stored in the given peer, or in all the peers,
+        that are not stored, and keep them in the cache. Return their hashes.
+
+        The seeding stops when the cache reaches its budget, so the songs
+        fetched don't push the ones cached out of it.
+        '''
+        if self._fetcher is None:
+            raise ValueError('no peers')
+        if peer is None:
+            peers = self._fetcher.peers
+        elif peer in self._fetcher.peers:
+            peers = [peer]
+        else:
+            raise ValueError('unknown peer')
+        fetched = []
+        for url in peers:
+            # Skip the peers that don't answer, unless one was given
+            try:
+                hashes = await self._fetcher.index(url)
+            except ValueError as e:
+                if peer is not None:
+                    raise
+                logging.warning(e)
+                continue
+            missing = [h for h in hashes if h not in self._sizes]
+            for i, hash_ in enumerate(missing):
+                if self._full():
+                    logging.warning(f'cache full, {len(missing) - i} songs '
+                        f'of {url} not seeded')
+                    return fetched
+                if hash_ in self._sizes:
+                    continue
+                try:
+                    if await self.acquire(hash_):
+                        self.release(hash_)
+                        fetched.append(hash_)
+                except ValueError as e:
+                    logging.warning(f'cannot fetch song {hash_}: {e}')
+        return fetched
+
+    def songs(self):
+        '''Return the hashes of all the songs stored.'''
+        return list(self._sizes)
+
+    async def store(self, data):
+        '''Store a song and add a reference to it. Return its hash.'''
+        # Compute the hash of the song
+        hash_ = await self._run(self._hash, data)
+
+        # Save the song to disk if necessary
+        async with self._lockhash(hash_):
+            if not self._acquire(hash_):
+                self._checkdecodable(hash_)
+                await self._run(self._save, data, hash_)
+                await self._validate(hash_)
+                self._add(hash_, len(data))
+        return hash_
+
+    async def storeupload(self, upload):
+        '''Store a song received with an upload and add a reference to it.
+        Return its hash.
+        '''
+        hash_ = await upload.finish()
+
+        # Move the song to its place if necessary
+        async with self._lockhash(hash_):
+            if not self._acquire(hash_):
+                self._checkdecodable(hash_)
+                await self._run(upload.rename, self.path(hash_))
+                await self._validate(hash_)
+                self._add(hash_, upload.size)
+        upload.discard()
+        return hash_
+
+    def _acquire(self, hash_):
+        '''Add a reference to a stored song, if it is stored.'''
+        try:
+            self._refcount[hash_] += 1
+        except KeyError:
+            if hash_ not in self._sizes:
+                return False
+            del self._cached[hash_]
+            self._refcount[hash_] = 1
+        return True
+
+    @staticmethod
+    def _advise(path, advice):
+        '''Give advice to the system about the use of a file.'''
+        if advice is None:
+            return
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return
+        try:
+            os.posix_fadvise(fd, 0, 0, advice)
+        finally:
+            os.close(fd)
+
+    def _add(self, hash_, size):
+        '''Add a new song to the index, with one reference.'''
+        self._refcount[hash_] = 1
+        self._sizes[hash_] = size
+        self._size += size
+        self._evict()
+
+    def _checkdecodable(self, hash_):
+        '''Raise an error if the song is known not to be decodable.'''
+        if not self.metadata(hash_).decodable:
+            raise ValueError('song not decodable')
+
+    def _delete(self, hash_):
+        '''Delete the file of a song in the background.
+
+        The file is deleted only if the song was not stored again in the
+        meantime.
+        '''
+        async def delete():
+            async with self._lockhash(hash_):
+                if hash_ not in self._sizes:
+                    await self._run(os.unlink, self.path(hash_))
+        tornado.ioloop.IOLoop.current().spawn_callback(delete)
+
+    async def _discover(self, hash_):
+        '''Discover the metadata of a song with the discoverer.
 
+        If the song can't be discovered now, it is left to be discovered
+        again later, and not taken as not decodable.
+        '''
+        try:
+            if self._discoverer is None:
+                return
+            try:
+                metadata = await self._discoverer.discover(self.path(hash_))
+            except OSError as e:
+                logging.warning(e)
+                return
+            if metadata is not None:
+                self.metadata(hash_).update(metadata)
+            self.metadata(hash_).discovered = True
+            self.metadata(hash_).decodable = metadata is not None
+            self._metadata.save(hash_)
+        finally:
+            del self._discoveries[hash_]
+
+    def _evict(self):
+        '''Remove the least recently used songs not referenced until the
+        cache is within its budget.
+        '''
+        while self._cached and (
+                (self._maxsize is not None and self._size > self._maxsize)
+                or (self._maxcount is not None
+                    and len(self._sizes) > self._maxcount)):
+            hash_, _ = self._cached.popitem(last=False)
+            self._size -= self._sizes.pop(hash_)
+            self._delete(hash_)
+
+    async def _fetch(self, hash_):
+        '''Fetch a song from the other music servers and add it to the index,
+        with one reference. Return False if no one has it.
+        '''
+        self._checkdecodable(hash_)
+        upload = self.newupload()
+        try:
+            if not await self._fetcher.fetch(hash_, upload):
+                return False
+            if await upload.finish() != hash_:
+                raise ValueError('song fetched corrupted')
+            await self._run(upload.rename, self.path(hash_))
+            await self._validate(hash_)
+            self._add(hash_, upload.size)
+            return True
+        finally:
+            upload.discard()
+
+    def _full(self):
+        '''Return whether the cache reached its budget.'''
+        return ((self._maxsize is not None and self._size >= self._maxsize)
+            or (self._maxcount is not None
+                and len(self._sizes) >= self._maxcount))
+
+    def _hash(self, data):
+        '''Compute the hash of the given data.'''
+        m = hashlib.sha256()
+        m.update(data)
+        return m.hexdigest()
+
+    @staticmethod
+    def _ishash(hash_):
+        '''Return whether a string may be the hash of a song.'''
+        return len(hash_) == 64 and not hash_.strip('0123456789abcdef')
+
+    def _load(self):
+        '''Rebuild the index from the files in the songs directory.'''
+        entries = []
+        with os.scandir(self._songdir) as it:
+            for entry in it:
+                if entry.name.startswith(SongUpload.PREFIX):
+                    # Remove the uploads interrupted
+                    os.unlink(entry.path)
+                elif entry.is_file():
+                    st = entry.stat()
+                    entries.append((st.st_mtime, entry.name, st.st_size))
+
+        # The songs used less recently go first
+        entries.sort()
+        for _, hash_, size in entries:
+            self._cached[hash_] = None
+            self._sizes[hash_] = size
+            self._size += size
+        self._evict()
+
+    @contextlib.asynccontextmanager
+    async def _lockhash(self, hash_):
+        '''Serialize the disk operations on the given hash.'''
+        try:
+            lock, users = self._locks[hash_]
+        except KeyError:
+            lock, users = tornado.locks.Lock(), 0
+        self._locks[hash_] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self._locks[hash_]
+            if users == 1:
+                del self._locks[hash_]
+            else:
+                self._locks[hash_] = (lock, users - 1)
+
+    def _run(self, function, *args):
+        '''Run the given function in the pool of workers.'''
+        return tornado.ioloop.IOLoop.current().run_in_executor(
+            self._executor, function, *args)
+
+    def _save(self, data, name):
+        '''Save the given song to the songs directory.'''
+        with open(self.path(name), 'wb') as f:
+            f.write(data)
+
+    async def _validate(self, hash_):
+        '''Check that a song just written can be decoded, discovering its
+        metadata. If it can't, its file is removed.
+        '''
+        metadata = await self.discover(hash_)
+        if not metadata.decodable:
+            await self._run(os.unlink, self.path(hash_))
+            raise ValueError('song not decodable')
+
+    @staticmethod
+    def _touch(path):
+        '''Update the modification time of a file, that keeps the order of
+        the cache across restarts.
+        '''
+        try:
+            os.utime(path)
+        except FileNotFoundError: pass
+
+class SongUpload:
+    '''A song received in chunks.
+
+    The chunks are written to a temporary file in the songs directory and
+    hashed as they arrive, in the given executor. Once finished, the file is
+    renamed to its final name.
+    '''
+
+    PREFIX = '.upload-'
+
+    def __init__(self, songdir, executor):
+        fd, self._path = tempfile.mkstemp(dir=songdir, prefix=self.PREFIX)
+        self._file = os.fdopen(fd, 'wb')
+        self._hash = hashlib.sha256()
+        self._executor = executor
+        self.size = 0
+
+    def discard(self):
+        '''Remove the temporary file in the background, if it still exists.'''
+        if self._path is not None:
+            self._executor.submit(self._discard, self._file, self._path)
+            self._path = None
+
+    async def finish(self):
+        '''Finish the upload and return the hash of the song.'''
+        await self._run(self._file.close)
+        return self._hash.hexdigest()
+
+    def rename(self, path):
+        '''Atomically move the song to its final path.'''
+        os.replace(self._path, path)
+        self._path = None
+
+    async def write(self, chunk):
+        '''Write a chunk of the song.'''
+        await self._run(self._write, chunk)
+
+    @staticmethod
+    def _discard(file_, path):
+        '''Close and remove the temporary file.'''
+        file_.close()
+        try:
+            os.unlink(path)
+        except FileNotFoundError: pass
+
+    def _run(self, function, *args):
+        '''Run the given function in the executor.'''
+        return tornado.ioloop.IOLoop.current().run_in_executor(
+            self._executor, function, *args)
+
+    def _write(self, chunk):
+        '''Write a chunk of the song and update its hash.'''
+        self._file.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+
+def _create_store(configuration):
+    '''Create the SongStore from the configuration.'''
+    # Get the directory where the songs will be stored
+    try:
+        songdir = configuration['musicserver']['songdir']
+    except KeyError:
+        songdir = DEFAULT_SONGDIR
+
+    # Get the number of threads that hash and store the songs
+    try:
+        workers = configuration['musicserver']['storageworkers']
+    except KeyError:
+        workers = DEFAULT_STORAGE_WORKERS
+
+    # Get the budget of the cache of songs
+    try:
+        cachesize = configuration['musicserver']['cachesize']
+    except KeyError:
+        cachesize = DEFAULT_CACHE_SIZE
+    try:
+        cachecount = configuration['musicserver']['cachecount']
+    except KeyError:
+        cachecount = DEFAULT_CACHE_COUNT
+
+    # Get the number of threads that discover the metadata of the songs
+    try:
+        discoverworkers = configuration['musicserver']['discoverworkers']
+    except KeyError:
+        discoverworkers = DEFAULT_DISCOVER_WORKERS
+    try:
+        discovertimeout = configuration['musicserver']['discovertimeout']
+    except KeyError:
+        discovertimeout = DEFAULT_DISCOVER_TIMEOUT
+
+    # Get the database where the metadata of the songs is kept, by
+    # default next to the songs directory
+    try:
+        metadatadb = configuration['musicserver']['metadatadb']
+    except KeyError:
+        metadatadb = os.path.join(
+            os.path.dirname(os.path.normpath(songdir)), 'metadata.db')
+
+    # Get the other music servers where the songs not stored are fetched
+    # from, given the URLs of their web services
+    try:
+        peers = configuration['musicserver']['peers']
+    except KeyError:
+        peers = []
+    try:
+        maxsongsize = configuration['musicserver']['maxsongsize']
+    except KeyError:
+        maxsongsize = DEFAULT_MAX_SONG_SIZE
+    fetcher = SongFetcher(peers, maxsongsize) if peers else None
+
+    # Create the store
+    discoverer = SongDiscoverer(discoverworkers, discovertimeout)
+    metadata = MetadataStore(metadatadb)
+    return SongStore(songdir, workers, cachesize, cachecount, discoverer,
+        metadata, fetcher)
@@ -0,0 +1,178 @@
+'''A list with fast insertion and removal at any position.'''
+
+import itertools
+
+__author__ = 'Antonio Serrano Hernandez'
+__copyright__ = 'Copyright 2021'
+__license__ = 'proprietary'
+__version__ = '0.1'
+__maintainer__ = 'Antonio Serrano Hernandez'
+__email__ = 'toni.serranoh@gmail.com'
+__status__ = 'Development'
+
+class IndexedList:
+    '''A sequence that supports getting, inserting and removing values at any
+    position, and finding the position of a value, in O(log n) time.
+
+    The values are kept in blocks of bounded size, with a Fenwick tree over
+    the sizes of the blocks to find the block that holds a position. The
+    values must be hashable and unique, as the block of each value is
+    remembered to find its position.
+    '''
+
+    _LOAD = 512
+
+    def __init__(self, iterable=()):
+        self._blocks = []
+        self._tree = []
+        self._blockof = {}
+        self._positions = {}
+        self._len = 0
+        for value in iterable:
+            self.append(value)
+
+    def __contains__(self, value):
+        return value in self._blockof
+
+    def __getitem__(self, index):
+        block, offset = self._locate(self._normalize(index))[1:]
+        return block[offset]
+
+    def __delitem__(self, index):
+        self.pop(index)
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._blocks)
+
+    def __len__(self):
+        return self._len
+
+    def append(self, value):
+        '''Add a value at the end.'''
+        self.insert(self._len, value)
+
+    def clear(self):
+        '''Remove all the values.'''
+        self._blocks = []
+        self._blockof = {}
+        self._len = 0
+        self._rebuild()
+
+    def index(self, value):
+        '''Return the position of a value.'''
+        try:
+            block = self._blockof[value]
+        except KeyError:
+            raise ValueError('value not in list')
+        position = self._positions[id(block)]
+        return self._prefix(position) + block.index(value)
+
+    def insert(self, index, value):
+        '''Insert a value before the given position.'''
+        if value in self._blockof:
+            raise ValueError('value already in list')
+        if index < 0:
+            index = max(index + self._len, 0)
+        index = min(index, self._len)
+        if not self._blocks:
+            block = [value]
+            self._blocks.append(block)
+            self._blockof[value] = block
+            self._len = 1
+            self._rebuild()
+            return
+        if index == self._len:
+            position = len(self._blocks) - 1
+            block = self._blocks[position]
+            offset = len(block)
+        else:
+            position, block, offset = self._locate(index)
+        block.insert(offset, value)
+        self._blockof[value] = block
+        self._len += 1
+        self._add(position, 1)
+
+        # Split the block if it grows too much
+        if len(block) > 2 * self._LOAD:
+            newblock = block[self._LOAD:]
+            del block[self._LOAD:]
+            self._blocks.insert(position + 1, newblock)
+            for v in newblock:
+                self._blockof[v] = newblock
+            self._rebuild()
+
+    def iterfrom(self, index):
+        '''Return an iterator over the values from the given position.'''
+        if index >= self._len:
+            return iter(())
+        position, block, offset = self._locate(max(index, 0))
+        return itertools.chain(itertools.islice(block, offset, None),
+            itertools.chain.from_iterable(
+                itertools.islice(self._blocks, position + 1, None)))
+
+    def move(self, src, dst):
+        '''Move the value at position src to position dst.'''
+        dst = self._normalize(dst)
+        value = self.pop(src)
+        self.insert(dst, value)
+
+    def pop(self, index=-1):
+        '''Remove and return the value at the given position.'''
+        position, block, offset = self._locate(self._normalize(index))
+        value = block.pop(offset)
+        del self._blockof[value]
+        self._len -= 1
+        if block:
+            self._add(position, -1)
+        else:
+            del self._blocks[position]
+            self._rebuild()
+        return value
+
+    def _add(self, position, delta):
+        '''Add delta to the size of the block at the given position.'''
+        i = position + 1
+        while i <= len(self._blocks):
+            self._tree[i - 1] += delta
+            i += i & -i
+
+    def _locate(self, index):
+        '''Return the position of the block that holds the given index, the
+        block and the offset of the index in the block.
+        '''
+        position = 0
+        remaining = index
+        step = 1 << len(self._blocks).bit_length()
+        while step:
+            i = position + step
+            if i <= len(self._blocks) and self._tree[i - 1] <= remaining:
+                position = i
+                remaining -= self._tree[i - 1]
+            step >>= 1
+        return position, self._blocks[position], remaining
+
+    def _normalize(self, index):
+        '''Return a non negative index, checking that it's in range.'''
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError('list index out of range')
+        return index
+
+    def _prefix(self, position):
+        '''Return the number of values in the blocks before the given one.'''
+        total = 0
+        i = position
+        while i > 0:
+            total += self._tree[i - 1]
+            i -= i & -i
+        return total
+
+    def _rebuild(self):
+        '''Rebuild the Fenwick tree and the positions of the blocks.'''
+        self._tree = [len(b) for b in self._blocks]
+        for i in range(1, len(self._tree) + 1):
+            parent = i + (i & -i)
+            if parent <= len(self._tree):
+                self._tree[parent - 1] += self._tree[i - 1]
+        self._positions = {id(b): i for i, b in enumerate(self._blocks)}
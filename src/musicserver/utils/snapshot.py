@@ -0,0 +1,79 @@
+
+'''A value shared between processes through shared memory.'''
+
+import mmap
+import os
+import struct
+
+__author__ = 'Antonio Serrano Hernandez'
+__copyright__ = 'Copyright 2021'
+__license__ = 'proprietary'
+__version__ = '0.1'
+__maintainer__ = 'Antonio Serrano Hernandez'
+__email__ = 'toni.serranoh@gmail.com'
+__status__ = 'Development'
+
+class SharedSnapshot:
+    '''A value, in bytes, written by one process and read by many others
+    without locks.
+
+    The value is kept in a memory mapped file, after a header with a
+    sequence number and the length of the value. The writer makes the
+    sequence number odd while it writes, and the readers retry until they
+    copy the value with the same even sequence number before and after.
+
+    The writer creates the file with the given size, the readers open it
+    without size.
+    '''
+
+    _HEADER = struct.Struct('<QQ')
+    _MAX_READ_RETRIES = 100
+
+    def __init__(self, path, size=None):
+        self._path = path
+        if size is not None:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                os.ftruncate(fd, self._HEADER.size + size)
+                self._map = mmap.mmap(fd, 0)
+            finally:
+                os.close(fd)
+            self._size = size
+            self._seq = 0
+        else:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                self._map = mmap.mmap(fd, 0, prot=mmap.PROT_READ)
+            finally:
+                os.close(fd)
+            self._size = len(self._map) - self._HEADER.size
+
+    def close(self):
+        '''Unmap the file.'''
+        self._map.close()
+
+    def read(self):
+        '''Return the value, or None if there's no value or it can't be read
+        consistently.
+        '''
+        for _ in range(self._MAX_READ_RETRIES):
+            seq, length = self._HEADER.unpack_from(self._map)
+            if seq % 2:
+                continue
+            data = self._map[self._HEADER.size:self._HEADER.size + length]
+            if self._HEADER.unpack_from(self._map)[0] == seq:
+                return data if length else None
+        return None
+
+    def write(self, data):
+        '''Write a new value. Return False if it doesn't fit, and then there's
+        no value.
+        '''
+        if len(data) > self._size:
+            data = b''
+        self._seq += 1
+        self._HEADER.pack_into(self._map, 0, self._seq, 0)
+        self._map[self._HEADER.size:self._HEADER.size + len(data)] = data
+        self._seq += 1
+        self._HEADER.pack_into(self._map, 0, self._seq, len(data))
+        return bool(data)
@@ -1,10 +1,22 @@
 
 '''Web server and web service utilities.'''
 
+import asyncio
+import collections
+import contextlib
 import json
 import logging
+import os
 import socket
+import time
+import tornado.http1connection
 import tornado.httpclient
+import tornado.httpserver
+import tornado.httputil
+import tornado.ioloop
+import tornado.iostream
+import tornado.locks
+import tornado.netutil
 import tornado.web
 
 __author__ = 'Antonio Serrano Hernandez'
@@ -23,24 +35,67 @@ class BaseHandler(tornado.web.RequestHandler):
             setattr(self, k, v)
 
 class WebServer:
+    '''A web server.
+
+    The server listens in the given TCP port, unless it is None, and in the
+    Unix domain socket unix_socket, if given, with the permissions
+    unix_socket_mode. If reuse_port, many processes can listen in the same
+    TCP port, and the kernel balances the connections between them.
+
+    The connections are kept alive between requests, unless keep_alive is
+    False, and closed after idle_timeout seconds without receiving the
+    headers of a request. The body of a request must arrive in body_timeout
+    seconds, and can't be bigger than max_body_size bytes. Beyond
+    max_connections connections, or max_client_connections connections from
+    the same TCP client, the new connections are closed as soon as they are
+    accepted.
+    '''
 
     _MAX_LISTEN_RETRIES = 10
     _LISTEN_RETRY_SLEEP_TIME = 0.1
 
-    def __init__(self, handlers, port=8888, **kwargs):
+    def __init__(self, handlers, port=8888, chunk_size=None, keep_alive=True,
+            idle_timeout=None, body_timeout=None, max_body_size=None,
+            max_header_size=None, max_connections=None,
+            max_client_connections=None, unix_socket=None,
+            unix_socket_mode=0o600, reuse_port=False, **kwargs):
         tornado.httpclient.AsyncHTTPClient.configure(
             'tornado.curl_httpclient.CurlAsyncHTTPClient')
         self._port = port
+        self._unix_socket = unix_socket
+        self._unix_socket_mode = unix_socket_mode
+        self._reuse_port = reuse_port
+        self._httpserver_args = {
+            'no_keep_alive': not keep_alive,
+            'chunk_size': chunk_size,
+            'idle_connection_timeout': idle_timeout,
+            'body_timeout': body_timeout,
+            'max_body_size': max_body_size,
+            'max_header_size': max_header_size,
+            'max_connections': max_connections,
+            'max_client_connections': max_client_connections,
+        }
+        self._httpserver = None
+        self._ioloop = None
         self._closing = False
+        self._stopping = False
+        self._on_stop = None
         self._ready = False
         self._app = tornado.web.Application(handlers, **kwargs)
 
     async def _stop_callback(self):
-        if self._closing:
+        if self._closing and not self._stopping:
+            self._stopping = True
             self._stopcb.stop()
-            self._is_ready = False
+            self._ready = False
             self._httpserver.stop()
             await self._httpserver.close_all_connections()            
+            if self._unix_socket is not None:
+                try:
+                    os.unlink(self._unix_socket)
+                except FileNotFoundError: pass
+            if self._on_stop is not None:
+                self._on_stop()
             tornado.ioloop.IOLoop.current().stop()
 
     def addhandler(self, pattern, handler, data=None):
@@ -52,7 +107,14 @@ class WebServer:
 
     def run(self):
         logging.info('starting web.Server')
-        self._httpserver = self._app.listen(self._port, no_keep_alive=True)
+        self._httpserver = _HTTPServer(self._app, **self._httpserver_args)
+        if self._port is not None:
+            self._httpserver.add_sockets(tornado.netutil.bind_sockets(
+                self._port, reuse_port=self._reuse_port))
+        if self._unix_socket is not None:
+            self._httpserver.add_socket(tornado.netutil.bind_unix_socket(
+                self._unix_socket, self._unix_socket_mode))
+        self._ioloop = tornado.ioloop.IOLoop.current()
         self._ready = True
         self._stopcb = tornado.ioloop.PeriodicCallback(
             self._stop_callback, 1000)
@@ -60,15 +122,173 @@ class WebServer:
         tornado.ioloop.IOLoop.current().start()
         logging.info('exiting web.Server')
 
-    def stop(self):
+    def stop(self, on_stop=None):
+        '''Stop the server. Can be called from any thread, or from a signal
+        handler. The function on_stop, if given, is called in the IOLoop once
+        the server has closed all its connections, before the IOLoop stops.
+        '''
+        self._on_stop = on_stop
         self._closing = True
+        if self._ioloop is not None:
+            self._ioloop.add_callback(self._stop_callback)
 
     def ready(self):
         '''Return whether the server is ready or not.'''
         return self._ready
 
+    def stats(self):
+        '''Return the statistics of the connections.'''
+        if self._httpserver is None:
+            return None
+        return self._httpserver.stats()
+
+class _HTTPServer(tornado.httpserver.HTTPServer):
+    '''An HTTPServer that limits the number of connections, in total and
+    from each client, and counts the connections and the requests.
+    '''
+
+    def initialize(self, *args, max_connections=None,
+            max_client_connections=None, **kwargs):
+        super().initialize(*args, **kwargs)
+        self._max_connections = max_connections
+        self._max_client_connections = max_client_connections
+        self._clients = collections.Counter()
+        self._accepted = 0
+        self._rejected = 0
+        self._requests = 0
+
+    def handle_stream(self, stream, address):
+        '''Serve a new connection, unless there are too many.'''
+        client = self._client(address)
+        if ((self._max_connections is not None
+                    and len(self._connections) >= self._max_connections)
+                or (self._max_client_connections is not None
+                    and client is not None
+                    and self._clients[client] >=
+                        self._max_client_connections)):
+            self._rejected += 1
+            stream.close()
+            return
+        self._accepted += 1
+        if client is not None:
+            self._clients[client] += 1
+        super().handle_stream(stream, address)
+
+    def on_close(self, server_conn):
+        '''Forget a connection closed.'''
+        super().on_close(server_conn)
+        client = self._client(server_conn.context.address)
+        if client is not None:
+            self._clients[client] -= 1
+            if not self._clients[client]:
+                del self._clients[client]
+
+    def start_request(self, server_conn, request_conn):
+        '''Count the request, once its headers are received. The request is
+        started before, while the connection waits for it.
+        '''
+        return _CountingDelegate(
+            self, super().start_request(server_conn, request_conn))
+
+    def count_request(self):
+        '''Count a new request.'''
+        self._requests += 1
+
+    def stats(self):
+        '''Return the statistics of the connections.'''
+        return {
+            'connections': len(self._connections),
+            'clients': len(self._clients),
+            'accepted': self._accepted,
+            'rejected': self._rejected,
+            'requests': self._requests,
+            'requestsperconnection': (self._requests / self._accepted
+                if self._accepted else None),
+        }
+
+    @staticmethod
+    def _client(address):
+        '''Return the client of a connection, given its address, or None for
+        the local clients connected to a Unix domain socket.
+        '''
+        if isinstance(address, tuple):
+            return address[0]
+        return None
+
+class _CountingDelegate(tornado.httputil.HTTPMessageDelegate):
+    '''Counts the requests received by an _HTTPServer, delegating them to
+    the given delegate.
+    '''
+
+    def __init__(self, server, delegate):
+        self._server = server
+        self._delegate = delegate
+
+    def headers_received(self, start_line, headers):
+        self._server.count_request()
+        return self._delegate.headers_received(start_line, headers)
+
+    def data_received(self, chunk):
+        return self._delegate.data_received(chunk)
+
+    def finish(self):
+        self._delegate.finish()
+
+    def on_connection_close(self):
+        self._delegate.on_connection_close()
+
+@tornado.web.stream_request_body
 class ServiceHandler(BaseHandler):
 
+    # The pieces of a result at least this big, as the playlist serialized
+    # beforehand, are sent on their own, so they aren't copied to join them
+    # with the others
+    _OWN_WRITE_SIZE = 64 * 1024
+
+    def prepare(self):
+        '''Prepare the reception of the request body.
+
+        If the request is a POST to a stream method, the method receives the
+        body in chunks as it arrives. Otherwise, the body is buffered and
+        given to the method as usual.
+        '''
+        self._chunks = []
+        self._stream = None
+        self._stream_error = None
+        if self.request.method == 'POST':
+            try:
+                self._stream = self.webservice.streammethod(
+                    self.path_args[0], self.request)
+            except KeyError:
+                return
+            max_body_size = self._stream.max_body_size()
+            if max_body_size is not None:
+                self.request.connection.set_max_body_size(max_body_size)
+            try:
+                self._stream.begin()
+            except Exception as e:
+                self._stream_error = e
+
+    async def data_received(self, chunk):
+        '''Receive a chunk of the request body.'''
+        if self._stream is None:
+            self._chunks.append(chunk)
+        elif self._stream_error is None:
+            try:
+                await self._stream.data_received(chunk)
+            except Exception as e:
+                self._stream_error = e
+
+    def on_finish(self):
+        '''Release the resources of the stream method, if any.'''
+        if self._stream is not None:
+            self._stream.close()
+
+    def on_connection_close(self):
+        '''Release the resources of the stream method, if any.'''
+        if self._stream is not None:
+            self._stream.close()
+
     async def _execute_method(self, method):
         '''Execute the given web service method.'''
         # Get the function attributes
@@ -78,11 +298,35 @@ class ServiceHandler(BaseHandler):
         # Call the webservice method
         try:
             result = WebServiceResult(await method.execute(**attrs))
+        except NotModified:
+            result = None
         except Exception as e:
             result = WebServiceErrorResult(e)
 
         # Return the result serialized
-        self.write(result.tojson())
+        for name, value in method.headers.items():
+            self.set_header(name, value)
+        if result is None:
+            self.set_status(304)
+            return
+        chunks = result.chunks()
+        self.set_header('Content-Length', sum(len(c) for c in chunks))
+        pending = False
+        for chunk in chunks:
+            if len(chunk) < self._OWN_WRITE_SIZE:
+                self.write(chunk)
+                pending = True
+                continue
+            # The headers are sent before, joined with the pieces pending
+            if pending or not self._headers_written:
+                await self.flush()
+            self.write(chunk)
+            await self.flush()
+            pending = False
+
+    def compute_etag(self):
+        '''Don't hash every response, the methods set their own ETag.'''
+        return None
 
     def _error(self, errormsg):
         '''Return an error.'''
@@ -102,6 +346,14 @@ class ServiceHandler(BaseHandler):
     async def post(self, method):
         '''Serve webservice functions as post.'''
         # Get the method to execute
+        if self._stream is not None:
+            if self._stream_error is not None:
+                self._error(self._stream_error)
+            else:
+                await self._execute_method(self._stream)
+            return
+        self.request.body = b''.join(self._chunks)
+        self._chunks = []
         try:
             m = self.webservice.postmethod(method, self.request)
             await self._execute_method(m)
@@ -111,18 +363,20 @@ class ServiceHandler(BaseHandler):
 
 class WebService:
 
-    GET, POST = range(2)
+    GET, POST, STREAM = range(3)
 
     def __init__(self, base, server, data=None):
         server.addhandler(r'/{}/(.*)'.format(base), ServiceHandler,
             data={'webservice': self})
+        self._server = server
         self._data = data
         self._get = {}
         self._post = {}
+        self._stream = {}
 
         # Prepare a dictionary with the different types to the right methods
         self._methods = [
-            self._get, self._post
+            self._get, self._post, self._stream
         ]
 
     def addmethods(self, methods):
@@ -132,18 +386,154 @@ class WebService:
 
     def getmethod(self, method, request):
         '''Return a get method given its name.'''
-        return self._get[method](request, self._data)
+        return self._get[method](request, self._data, self)
+
+    @property
+    def server(self):
+        '''Return the web server of this web service.'''
+        return self._server
 
     def postmethod(self, method, request):
         '''Return a post method given its name.'''
-        return self._post[method](request, self._data)
+        return self._post[method](request, self._data, self)
+
+    def streammethod(self, method, request):
+        '''Return a stream method given its name.'''
+        return self._stream[method](request, self._data, self)
+
+class NotModified(Exception):
+    '''Raised by a web service method to answer 304 Not Modified.'''
+    pass
 
 class WebServiceMethod:
-    '''Base class for all web service methods.'''
+    '''Base class for all web service methods.
 
-    def __init__(self, request, data):
+    The headers set in the headers dictionary are added to the response.
+    The methods executed inside a batch have batched set, and the headers of
+    the request don't apply to them.
+    '''
+
+    def __init__(self, request, data, service=None):
         self.request = request
         self.data = data
+        self.service = service
+        self.headers = {}
+        self.batched = False
+
+    @property
+    def server(self):
+        '''Return the web server of the web service of this method.'''
+        return self.service.server
+
+    def etagmatches(self, etag):
+        '''Return whether the If-None-Match header of the request matches
+        the given ETag. Never inside a batch, where the header belongs to the
+        whole batch.
+        '''
+        header = self.request.headers.get('If-None-Match')
+        if header is None or self.batched:
+            return False
+        tags = [t.strip() for t in header.split(',')]
+        tags = [t[2:] if t.startswith('W/') else t for t in tags]
+        return '*' in tags or etag in tags
+
+class StreamWebServiceMethod(WebServiceMethod):
+    '''Base class for web service methods that receive the body of a POST
+    request in chunks, as it arrives, instead of all at once.
+    '''
+
+    def max_body_size(self):
+        '''Return the maximum size of the body accepted, or None to use the
+        server's default.
+        '''
+        return None
+
+    def begin(self):
+        '''Called before the first chunk of the body is received.'''
+        pass
+
+    async def data_received(self, chunk):
+        '''Receive a chunk of the body. By default, the chunks are
+        discarded.
+        '''
+        pass
+
+    def close(self):
+        '''Called when the request is finished or the connection is lost.
+        Must release any resource still held by the method.
+        '''
+        pass
+
+class BatchWebServiceMethod(WebServiceMethod):
+    '''Base class for the methods that execute many GET methods of their web
+    service in one request.
+
+    The body of the request is a JSON array of {"method": name, "args": {}}
+    objects. The arguments are given to the methods as if they came in the
+    query string. The result is an array with the result of each method.
+
+    The methods are executed inside the asynchronous context manager
+    returned by transaction. If atomic, the execution stops at the first
+    error, that is raised through the context manager, so that it can undo
+    the changes, and the whole request fails.
+    '''
+
+    def transaction(self, atomic):
+        '''Return the context manager the methods are executed in.'''
+        if atomic:
+            raise ValueError('atomic batches not supported')
+        return contextlib.nullcontext()
+
+    async def execute(self, atomic='false'):
+        '''Execute the methods in the body of the request.'''
+        atomic = atomic.lower() in ('true', '1')
+        try:
+            commands = json.loads(self.request.body)
+        except ValueError:
+            raise ValueError('wrong batch')
+        if not isinstance(commands, list):
+            raise ValueError('wrong batch')
+
+        parts = [b'[']
+        async with self.transaction(atomic):
+            for i, command in enumerate(commands):
+                try:
+                    result = WebServiceResult(await self._execute(command))
+                except Exception as e:
+                    if atomic:
+                        raise ValueError(f'command {i} failed: {e}') from e
+                    result = WebServiceErrorResult(e)
+                if i:
+                    parts.append(b', ')
+                parts.extend(result.chunks())
+        parts.append(b']')
+        return EncodedJSON(*parts)
+
+    async def _execute(self, command):
+        '''Execute a command of the batch.'''
+        try:
+            name = command['method']
+            args = command.get('args', {})
+            args = {k: v if isinstance(v, str) else json.dumps(v)
+                for k, v in args.items()}
+        except (AttributeError, KeyError, TypeError):
+            raise ValueError('wrong command')
+        try:
+            method = self.service.getmethod(name, self.request)
+        except KeyError:
+            raise ValueError(f'unknown method {name}')
+        method.batched = True
+        return await method.execute(**args)
+
+class EncodedJSON:
+    '''A value already serialized as json, in pieces of bytes.
+
+    Can be returned by a web service method to send a value serialized
+    beforehand without serializing it again.
+    '''
+
+    def __init__(self, *parts):
+        self.parts = parts
 
 class WebServiceResult:
     '''Contains the value returned by a web service method.'''
@@ -151,8 +541,18 @@ class WebServiceResult:
     def __init__(self, data):
         self._data = data
 
+    def chunks(self):
+        '''Return the data of the result serialized as json, in pieces of
+        bytes.
+        '''
+        if isinstance(self._data, EncodedJSON):
+            return [b'{"error": false, "data": ', *self._data.parts, b'}']
+        return [self.tojson().encode('utf-8')]
+
     def tojson(self):
         '''Return the data of the result serialized as json.'''
+        if isinstance(self._data, EncodedJSON):
+            return b''.join(self.chunks()).decode('utf-8')
         return json.dumps({'error': False, 'data': self._data})
 
 class WebServiceErrorResult:
@@ -161,7 +561,552 @@ class WebServiceErrorResult:
     def __init__(self, error):
         self._errorstr = str(error)
 
+    def chunks(self):
+        '''Return the data of the result serialized as json, in pieces of
+        bytes.
+        '''
+        return [self.tojson().encode('utf-8')]
+
     def tojson(self):
         '''Return the data of the result serialized as json.'''
         return json.dumps({'error': True, 'errmsg': self._errorstr})
 
+
+class Publisher:
+    '''Publishes messages to many subscribers.
+
+    Each message is encoded only once, and queued for every subscriber. The
+    full state is encoded once too, and shared by all the subscribers that
+    need it, until the next message is published.
+    '''
+
+    def __init__(self, snapshot, queuesize=64):
+        '''Create the publisher.
+
+        * snapshot: function that returns the full state, that is sent to the
+            subscribers when they start and when they fall behind. It may
+            return an EncodedJSON.
+        * queuesize: maximum number of messages queued for a subscriber.
+        '''
+        self._snapshot = snapshot
+        self._encodedsnapshot = None
+        self._queuesize = queuesize
+        self._subscribers = set()
+
+    def __len__(self):
+        '''Return the number of subscribers.'''
+        return len(self._subscribers)
+
+    def publish(self, message, throttled=False):
+        '''Publish a message to all the subscribers.
+
+        If throttled, the subscribers only receive the message if their
+        interval since the last throttled message has elapsed.
+        '''
+        self._encodedsnapshot = None
+        if not self._subscribers:
+            return
+        data = json.dumps(message).encode('utf-8')
+        for subscriber in self._subscribers:
+            subscriber.put(data, throttled)
+
+    def resync(self):
+        '''Send the full state again to all the subscribers, instead of the
+        messages queued.
+        '''
+        for subscriber in self._subscribers:
+            subscriber.resync()
+
+    def snapshot(self):
+        '''Return the full state encoded.'''
+        if self._encodedsnapshot is None:
+            state = self._snapshot()
+            if isinstance(state, EncodedJSON):
+                self._encodedsnapshot = b''.join(
+                    [b'{"type": "snapshot", "data": ', *state.parts, b'}'])
+            else:
+                self._encodedsnapshot = json.dumps(
+                    {'type': 'snapshot', 'data': state}).encode('utf-8')
+        return self._encodedsnapshot
+
+    def subscribe(self, interval=0.0):
+        '''Return a new subscriber.'''
+        subscriber = Subscriber(self, self._queuesize, interval)
+        self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        '''Remove a subscriber.'''
+        self._subscribers.discard(subscriber)
+
+class Subscriber:
+    '''Receives the messages of a Publisher and sends them to a client.
+
+    The messages are kept in a bounded queue. If the client is too slow and
+    the queue gets full, the messages queued are dropped and the client
+    receives a new snapshot instead, so a slow client never makes the server
+    buffer without limit.
+    '''
+
+    def __init__(self, publisher, queuesize, interval):
+        self._publisher = publisher
+        self._queue = collections.deque()
+        self._queuesize = queuesize
+        self._interval = interval
+        self._lastthrottled = None
+        self._resync = True
+        self._closed = False
+        self._event = tornado.locks.Event()
+
+        # The first message is the snapshot
+        self._event.set()
+
+    def close(self):
+        '''Stop receiving messages.'''
+        self._closed = True
+        self._publisher.unsubscribe(self)
+        self._event.set()
+
+    def put(self, data, throttled=False):
+        '''Queue a message for the client.'''
+        if throttled:
+            now = time.monotonic()
+            if (self._lastthrottled is not None
+                    and now - self._lastthrottled < self._interval):
+                return
+            self._lastthrottled = now
+        if len(self._queue) >= self._queuesize:
+            # The client is too slow, send it a new snapshot instead
+            self._queue.clear()
+            self._resync = True
+        elif not self._resync:
+            self._queue.append(data)
+        self._event.set()
+
+    def resync(self):
+        '''Send the full state instead of the messages queued.'''
+        self._queue.clear()
+        self._resync = True
+        self._event.set()
+
+    async def run(self, send):
+        '''Send the messages to the client, using the given coroutine,
+        until the subscriber is closed.
+        '''
+        try:
+            while not self._closed:
+                await self._event.wait()
+                self._event.clear()
+                while not self._closed and (self._resync or self._queue):
+                    if self._resync:
+                        self._resync = False
+                        await send(self._publisher.snapshot())
+                    else:
+                        await send(self._queue.popleft())
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            self.close()
+
+class SubscriptionHandler(BaseHandler):
+    '''Sends the messages of a publisher as Server-Sent Events.'''
+
+    def initialize(self, **kwargs):
+        super().initialize(**kwargs)
+        self._subscriber = None
+
+    async def get(self):
+        try:
+            interval = float(self.get_query_argument('interval', 0.0))
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'wrong interval')
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        self._subscriber = self.publisher.subscribe(interval)
+        await self._subscriber.run(self._send)
+
+    def on_connection_close(self):
+        if self._subscriber is not None:
+            self._subscriber.close()
+
+    async def _send(self, data):
+        self.write(b'data: ')
+        self.write(data)
+        self.write(b'\n\n')
+        await self.flush()
+
+class WebSubscription:
+    '''Lets clients subscribe to the messages of a publisher with
+    Server-Sent Events at /<base>/events. The optional interval argument sets
+    the minimum time between throttled messages.
+
+    Must be created before any WebService with the same base.
+    '''
+
+    def __init__(self, base, server, publisher):
+        server.addhandler(r'/{}/events'.format(base),
+            SubscriptionHandler, data={'publisher': publisher})
+
+class LiveStream:
+    '''A live stream of bytes, as an encoded audio stream, sent to many
+    listeners.
+
+    The bytes written are joined in chunks of chunksize bytes, and the last
+    size chunks are kept in a ring. Every chunk is sent as is to all the
+    listeners, without copying it for each one. A listener so slow that its
+    next chunk is dropped from the ring jumps to the live edge, so a slow
+    listener never makes the server buffer without limit. Beyond
+    maxlisteners listeners, the new ones are rejected.
+    '''
+
+    def __init__(self, contenttype, chunksize=4096, size=64,
+            maxlisteners=None):
+        self.contenttype = contenttype
+        self._chunksize = chunksize
+        self._maxlisteners = maxlisteners
+        self._pending = bytearray()
+        self._chunks = collections.deque(maxlen=size)
+        self._end = 0
+        self._listeners = set()
+
+    def __len__(self):
+        '''Return the number of listeners.'''
+        return len(self._listeners)
+
+    def close(self):
+        '''Stop sending the stream to all the listeners.'''
+        for listener in list(self._listeners):
+            listener.close()
+
+    def listen(self):
+        '''Return a new listener, that starts at the live edge, or None if
+        there are too many.
+        '''
+        if (self._maxlisteners is not None
+                and len(self._listeners) >= self._maxlisteners):
+            return None
+        listener = StreamListener(self, self._end)
+        self._listeners.add(listener)
+        return listener
+
+    def read(self, position):
+        '''Return the chunk at the given position of the stream, or None if
+        there isn't any yet, and the position of the next one. A position
+        already dropped from the ring is moved to the live edge.
+        '''
+        start = self._end - len(self._chunks)
+        if position < start:
+            position = max(self._end - 1, start)
+        if position >= self._end:
+            return None, position
+        return self._chunks[position - start], position + 1
+
+    def unlisten(self, listener):
+        '''Remove a listener.'''
+        self._listeners.discard(listener)
+
+    def write(self, data):
+        '''Write bytes to the stream.'''
+        self._pending.extend(data)
+        if len(self._pending) < self._chunksize:
+            return
+        self._chunks.append(bytes(self._pending))
+        self._pending.clear()
+        self._end += 1
+        for listener in self._listeners:
+            listener.wake()
+
+class StreamListener:
+    '''Sends the chunks of a LiveStream to a client, from the given
+    position.
+    '''
+
+    def __init__(self, stream, position):
+        self._stream = stream
+        self._position = position
+        self._closed = False
+        self._event = tornado.locks.Event()
+
+    def close(self):
+        '''Stop sending the stream.'''
+        self._closed = True
+        self._stream.unlisten(self)
+        self._event.set()
+
+    async def run(self, send):
+        '''Send the chunks to the client, using the given coroutine, until
+        the listener is closed.
+        '''
+        try:
+            while not self._closed:
+                await self._event.wait()
+                self._event.clear()
+                while not self._closed:
+                    chunk, self._position = self._stream.read(self._position)
+                    if chunk is None:
+                        break
+                    await send(chunk)
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            self.close()
+
+    def wake(self):
+        '''Tell the listener that there's a new chunk.'''
+        self._event.set()
+
+class LiveStreamHandler(BaseHandler):
+    '''Sends a LiveStream to a client, until it closes the connection.
+
+    The connection is taken from the HTTP server, so the chunks are written
+    to it directly, instead of copied in the HTTP chunked encoding, and the
+    end of the stream is the end of the connection.
+    '''
+
+    async def get(self):
+        listener = self.livestream.listen()
+        if listener is None:
+            raise tornado.web.HTTPError(503, 'too many listeners')
+        stream = self.detach()
+        stream.set_close_callback(listener.close)
+        try:
+            await stream.write(
+                b'HTTP/1.1 200 OK\r\n'
+                b'Content-Type: ' + self.livestream.contenttype.encode()
+                + b'\r\nCache-Control: no-cache\r\n'
+                b'Connection: close\r\n\r\n')
+        except tornado.iostream.StreamClosedError:
+            listener.close()
+        await listener.run(stream.write)
+        stream.close()
+
+class HashFileHandler(BaseHandler):
+    '''Serves the files of a directory, path, named by the hash of their
+    contents.
+
+    The files are read in chunks in the given executor, so a big file never
+    blocks the IOLoop, and the clients may ask for a range of bytes of them to
+    resume an interrupted download. The name of a file is its Etag, so the
+    file doesn't need to be read to compute it.
+    '''
+
+    _CHUNK_SIZE = 64 * 1024
+
+    async def get(self, name):
+        try:
+            f = await self._run(open, os.path.join(self.path, name), 'rb')
+        except FileNotFoundError:
+            raise tornado.web.HTTPError(404)
+        try:
+            await self._send(f, name)
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            self.executor.submit(f.close)
+
+    def compute_etag(self):
+        '''The Etag is set from the name of the file.'''
+        return None
+
+    def _range(self, size):
+        '''Return the range of bytes requested from a file of the given
+        size, or None if it is not satisfiable. The requests of many ranges,
+        or of ranges not understood, are answered with the whole file.
+        '''
+        header = self.request.headers.get('Range')
+        if header is None:
+            return 0, size
+        unit, _, spec = header.partition('=')
+        first, separator, last = spec.strip().partition('-')
+        if unit.strip() != 'bytes' or not separator or ',' in spec:
+            return 0, size
+        try:
+            if first:
+                start = int(first)
+                end = int(last) + 1 if last else size
+            else:
+                # The last bytes of the file
+                start = size - int(last)
+                end = size
+        except ValueError:
+            return 0, size
+        start = max(start, 0)
+        end = min(end, size)
+        if start >= end:
+            return None
+        if end - start != size:
+            self.set_status(206)
+            self.set_header('Content-Range', f'bytes {start}-{end - 1}/{size}')
+        return start, end
+
+    def _run(self, function, *args):
+        '''Run the given function in the executor.'''
+        return tornado.ioloop.IOLoop.current().run_in_executor(
+            self.executor, function, *args)
+
+    async def _send(self, f, name):
+        '''Send the range of bytes requested of a file.'''
+        size = os.fstat(f.fileno()).st_size
+        self.set_header('Etag', f'"{name}"')
+        self.set_header('Accept-Ranges', 'bytes')
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        range_ = self._range(size)
+        if range_ is None:
+            self.set_status(416)
+            self.set_header('Content-Range', f'bytes */{size}')
+            return
+        start, end = range_
+        self.set_header('Content-Type', 'application/octet-stream')
+        self.set_header('Content-Length', end - start)
+        await self._run(f.seek, start)
+        while start < end:
+            chunk = await self._run(
+                f.read, min(self._CHUNK_SIZE, end - start))
+            if not chunk:
+                break
+            start += len(chunk)
+            self.write(chunk)
+            await self.flush()
+
+@tornado.web.stream_request_body
+class ProxyHandler(BaseHandler):
+    '''Forwards the requests to another server, listening in the Unix domain
+    socket backend.
+
+    The bodies of the requests and the responses are forwarded in chunks as
+    they arrive, so uploads and streams of events are not buffered. If the
+    client closes the connection, the connection to the other server is
+    closed too. The handler may be initialized with the maximum size of the
+    request bodies, max_body_size.
+    '''
+
+    _HOP_HEADERS = {'Connection', 'Keep-Alive', 'Transfer-Encoding', 'Date',
+        'Server'}
+
+    def prepare(self):
+        '''Start forwarding the request.'''
+        self._stream = None
+        self._closed = False
+        max_body_size = getattr(self, 'max_body_size', None)
+        if max_body_size is not None:
+            self.request.connection.set_max_body_size(max_body_size)
+        self._connected = asyncio.ensure_future(self._connect())
+
+    async def data_received(self, chunk):
+        '''Forward a chunk of the request body.'''
+        try:
+            connection = await self._connected
+            await connection.write(chunk)
+        except (OSError, tornado.iostream.StreamClosedError):
+            # The error is answered when the whole request is received
+            pass
+
+    def compute_etag(self):
+        '''The Etag, if any, is the one of the other server.'''
+        return None
+
+    def on_connection_close(self):
+        '''Stop forwarding the response.'''
+        self._closed = True
+        if self._stream is not None:
+            self._stream.close()
+
+    async def get(self, *args):
+        await self._forward()
+
+    async def post(self, *args):
+        await self._forward()
+
+    async def _connect(self):
+        '''Connect to the other server and send the request headers.'''
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._stream = tornado.iostream.IOStream(sock)
+        await self._stream.connect(self.backend)
+        parameters = tornado.http1connection.HTTP1ConnectionParameters(
+            no_keep_alive=True, decompress=False)
+        connection = tornado.http1connection.HTTP1Connection(
+            self._stream, True, parameters)
+        headers = tornado.httputil.HTTPHeaders()
+        for name, value in self.request.headers.get_all():
+            if name not in self._HOP_HEADERS:
+                headers.add(name, value)
+        await connection.write_headers(tornado.httputil.RequestStartLine(
+            self.request.method, self.request.uri, 'HTTP/1.1'), headers)
+        return connection
+
+    async def _forward(self):
+        '''Finish the request and forward its response.'''
+        try:
+            connection = await self._connected
+            connection.finish()
+            await connection.read_response(_ProxyResponse(self))
+        except (OSError, tornado.iostream.StreamClosedError) as e:
+            if self._closed:
+                return
+            if self._headers_written:
+                self.request.connection.close()
+                return
+            logging.error(f'cannot forward request: {e}')
+            self.clear()
+            self.set_status(502)
+        finally:
+            if self._stream is not None:
+                self._stream.close()
+        if not self._closed:
+            self.finish()
+
+class _ProxyResponse(tornado.httputil.HTTPMessageDelegate):
+    '''Receives the response of the other server for a ProxyHandler.'''
+
+    def __init__(self, handler):
+        self._handler = handler
+
+    def headers_received(self, start_line, headers):
+        self._handler.clear()
+        self._handler._headers.clear()
+        self._handler.set_status(start_line.code, start_line.reason)
+        for name, value in headers.get_all():
+            if name not in ProxyHandler._HOP_HEADERS:
+                self._handler.add_header(name, value)
+
+    async def data_received(self, chunk):
+        # Wait for the client, so a slow client slows the other server
+        if not self._handler._closed:
+            self._handler.write(chunk)
+            await self._handler.flush()
+
+class SnapshotHandler(ProxyHandler):
+    '''Serves the GET requests without arguments with the response stored in
+    a SharedSnapshot, encoded with encodesnapshot, and forwards the others.
+    '''
+
+    def prepare(self):
+        self._data = None
+        self._stream = None
+        if self.request.method == 'GET' and not self.request.query_arguments:
+            self._data = self.snapshot.read()
+        if self._data is None:
+            super().prepare()
+
+    async def get(self, *args):
+        if self._data is None:
+            await super().get(*args)
+            return
+
+        # Answer Not Modified if the client already has this response
+        header, body = self._data.split(b'\n', 1)
+        headers = json.loads(header)
+        for name, value in headers.items():
+            self.set_header(name, value)
+        if 'Etag' in headers and self.check_etag_header():
+            self.set_status(304)
+        else:
+            self.write(body)
+
+def encodesnapshot(headers, chunks):
+    '''Encode a response, given its headers and its body in chunks, to be
+    served by a SnapshotHandler.
+    '''
+    return b''.join([json.dumps(headers).encode('utf-8'), b'\n', *chunks])
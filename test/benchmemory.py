@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+'''Benchmark of the memory used by each song queued in the playlist.'''
+
+import os
+import sys
+import tempfile
+import tracemalloc
+
+import tornado.ioloop
+
+TEST_PATH = os.path.dirname(sys.argv[0])
+ROOT_PATH = os.path.join(TEST_PATH, '..', 'src')
+
+sys.path.insert(0, ROOT_PATH)
+import musicserver
+
+SONGS = 100000
+TITLES = 100
+
+async def bench(songdir):
+    '''Measure the bytes used by each song queued, enqueuing the test song
+    many times with a few different titles.
+    '''
+    store = musicserver.SongStore(songdir)
+    playlist = musicserver.Playlist(store, SONGS + 1)
+    with open(os.path.join(TEST_PATH, 'song1.webm'), 'rb') as f:
+        hash_ = await store.store(f.read())
+    store.release(hash_)
+
+    # The titles are received as new strings with every request
+    titles = [f'song{i % TITLES}'.encode('utf-8') for i in range(SONGS)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for title in titles:
+        await playlist.enqueuehash(title.decode('utf-8'), hash_)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f'{SONGS} songs queued with {TITLES} titles: '
+        f'{(after - before) / SONGS:.1f} bytes per song')
+    playlist.clear()
+    playlist.close()
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as songdir:
+        tornado.ioloop.IOLoop.current().run_sync(lambda: bench(songdir))
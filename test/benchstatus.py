@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+'''Benchmark of the throughput of the status method with a long playlist.'''
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import urllib.request
+
+TEST_PATH = os.path.dirname(sys.argv[0])
+ROOT_PATH = os.path.join(TEST_PATH, '..', 'src')
+
+sys.path.insert(0, ROOT_PATH)
+import musicserver
+
+BASE_URL = 'http://localhost:8888/musicserver'
+SONGS = 10000
+REQUESTS = 2000
+CLIENTS = 8
+
+def enqueue_songs():
+    '''Enqueue SONGS songs, uploading the test song only once.'''
+    song = os.path.join(TEST_PATH, 'song1.webm')
+    with open(song, 'rb') as f:
+        data = f.read()
+    hash_ = hashlib.sha256(data).hexdigest()
+    request = urllib.request.Request(
+        f'{BASE_URL}/enqueue?title=song0', data,
+        headers={'Content-Type': 'audio/webm'})
+    urllib.request.urlopen(request).read()
+    for i in range(1, SONGS):
+        urllib.request.urlopen(
+            f'{BASE_URL}/enqueuehash?hash={hash_}&title=song{i}').read()
+
+def status():
+    '''Retrieve the status and return the size of the response.'''
+    with urllib.request.urlopen(f'{BASE_URL}/status') as f:
+        body = f.read()
+    response = json.loads(body)
+    assert len(response['data']['playlist']['songs']) == SONGS
+    return len(body)
+
+def bench():
+    '''Measure the number of status requests served per second.'''
+    with concurrent.futures.ThreadPoolExecutor(CLIENTS) as executor:
+        start = time.perf_counter()
+        sizes = list(executor.map(lambda _: status(), range(REQUESTS)))
+        elapsed = time.perf_counter() - start
+    print(f'{REQUESTS} status requests with {SONGS} songs and {CLIENTS} '
+        f'clients: {elapsed:.2f} s, {REQUESTS / elapsed:.1f} requests/s, '
+        f'{sum(sizes) / len(sizes):.0f} bytes/response')
+
+if __name__ == '__main__':
+    app = musicserver.Application(os.path.join(TEST_PATH, 'config6'))
+    def f():
+        while not app.ready():
+            time.sleep(0.1)
+        enqueue_songs()
+        bench()
+        app.stop()
+    t = threading.Thread(target=f)
+    t.start()
+    app.run()
+    t.join()
@@ -0,0 +1,72 @@
+
+import os
+import random
+import sys
+import unittest
+
+
+TEST_PATH = os.path.dirname(sys.argv[0])
+ROOT_PATH = os.path.join(TEST_PATH, '..', 'src')
+
+sys.path.insert(0, ROOT_PATH)
+import musicserver.utils.indexedlist as indexedlist
+
+class IndexedListTestCase(unittest.TestCase):
+    '''Test the IndexedList.'''
+
+    def setUp(self):
+        # Use small blocks to exercise their splitting and removal
+        self._load = indexedlist.IndexedList._LOAD
+        indexedlist.IndexedList._LOAD = 4
+
+    def tearDown(self):
+        indexedlist.IndexedList._LOAD = self._load
+
+    def test_operations(self):
+        '''Test the operations against a plain list.'''
+        rand = random.Random(0)
+        l = indexedlist.IndexedList()
+        expected = []
+        value = 0
+        for _ in range(5000):
+            op = rand.random()
+            if op < 0.4 or not expected:
+                index = rand.randint(-len(expected) - 1, len(expected) + 1)
+                l.insert(index, value)
+                expected.insert(index, value)
+                value += 1
+            elif op < 0.6:
+                index = rand.randrange(-len(expected), len(expected))
+                self.assertEquals(l.pop(index), expected.pop(index))
+            elif op < 0.75:
+                src = rand.randrange(len(expected))
+                dst = rand.randrange(len(expected))
+                l.move(src, dst)
+                expected.insert(dst, expected.pop(src))
+            elif op < 0.9:
+                v = rand.choice(expected)
+                self.assertEquals(l.index(v), expected.index(v))
+            else:
+                index = rand.randrange(len(expected))
+                self.assertEquals(l[index], expected[index])
+                self.assertEquals(list(l.iterfrom(index)), expected[index:])
+            self.assertEquals(len(l), len(expected))
+        self.assertEquals(list(l), expected)
+
+    def test_errors(self):
+        '''Test the wrong uses.'''
+        l = indexedlist.IndexedList(range(3))
+        with self.assertRaises(IndexError):
+            l[3]
+        with self.assertRaises(IndexError):
+            l.pop(-4)
+        with self.assertRaises(IndexError):
+            l.move(0, 3)
+        self.assertEquals(list(l), [0, 1, 2])
+        with self.assertRaises(ValueError):
+            l.index(3)
+        with self.assertRaises(ValueError):
+            l.insert(0, 1)
+        l.clear()
+        self.assertEquals(len(l), 0)
+        self.assertEquals(list(l.iterfrom(0)), [])
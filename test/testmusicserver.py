@@ -1,13 +1,23 @@
 
+import asyncio
+import hashlib
+import http.client
 import json
 import os
 import shutil
+import socket
+import sqlite3
+import subprocess
 import sys
+import tempfile
 import threading
 import time
 import unittest
+import urllib.error
 import urllib.request
 
+import tornado.ioloop
+
 
 TEST_PATH = os.path.dirname(sys.argv[0])
 ROOT_PATH = os.path.join(TEST_PATH, '..', 'src')
@@ -17,6 +27,17 @@ import musicserver
 
 SLEEPTIME = 0.2
 
+class UnixHTTPConnection(http.client.HTTPConnection):
+    '''An HTTP connection to a server listening in a Unix domain socket.'''
+
+    def __init__(self, path):
+        super().__init__('localhost')
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self._path)
+
 class MusicServerTestCase(unittest.TestCase):
     '''Test the music server.'''
 
@@ -50,6 +71,57 @@ class MusicServerTestCase(unittest.TestCase):
         self._app.run()
         t.join()
 
+    def test_unixsocket(self):
+        '''Test serving the requests only in a Unix domain socket.'''
+        self._app = musicserver.Application(
+            os.path.join(TEST_PATH, 'config15'))
+        def f():
+            self._waitready()
+            path = '/tmp/musicserver-test.sock'
+            self.assertEquals(os.stat(path).st_mode & 0o777, 0o660)
+            status = self._unixget(path, '/musicserver/status')
+            self.assertEquals(status['error'], False)
+            self.assertEquals(status['data']['player']['state'], 'stop')
+            self._app.stop()
+        t = threading.Thread(target=f)
+        t.start()
+        self._app.run()
+        t.join()
+
+    def test_max_client_connections(self):
+        '''Test refusing the connections from a client beyond its limit.'''
+        self._app = musicserver.Application(
+            os.path.join(TEST_PATH, 'config16'))
+        def f():
+            self._waitready()
+            held = [socket.create_connection(('localhost', 8888))
+                for _ in range(2)]
+            try:
+                # The connection beyond the limit is closed at once
+                with socket.create_connection(('localhost', 8888)) as extra:
+                    extra.settimeout(5.0)
+                    try:
+                        self.assertEquals(extra.recv(1), b'')
+                    except ConnectionResetError: pass
+
+                # Once a connection is closed, there's room for another one
+                held.pop().close()
+                time.sleep(SLEEPTIME)
+                stats = self._stats()['webserver']
+                self.assertEquals(stats['accepted'], 3)
+                self.assertEquals(stats['rejected'], 1)
+                self.assertEquals(stats['connections'], 2)
+                self.assertEquals(stats['clients'], 1)
+                self.assertEquals(stats['requests'], 1)
+            finally:
+                for s in held:
+                    s.close()
+            self._app.stop()
+        t = threading.Thread(target=f)
+        t.start()
+        self._app.run()
+        t.join()
+
     def test_clear_playlist(self):
         '''Test clear all the songs in the playlist.'''
         self._app = musicserver.Application(os.path.join(TEST_PATH, 'config2'))
@@ -126,13 +198,367 @@ class MusicServerTestCase(unittest.TestCase):
         self._app.run()
         t.join()
 
-    def _enqueue(self, song, title):
+    def test_metadata(self):
+        '''Test that the metadata of the songs is discovered when they are
+        enqueued.
+        '''
+        self._app = musicserver.Application(os.path.join(TEST_PATH, 'config2'))
+        def f():
+            self._waitready()
+            song = os.path.join(TEST_PATH, 'song1.webm')
+            self._enqueue(song, 'mysong')
+            self._enqueue(song, 'mysong2')
+
+            # The metadata is known without playing the songs
+            for _ in range(50):
+                status = self._check(['mysong', 'mysong2'], 0, 'stop')
+                songs = status['playlist']['songs']
+                if songs[1]['duration'] is not None:
+                    break
+                time.sleep(0.1)
+            for s in songs:
+                self.assertGreater(s['duration'], 0)
+                self.assertIsNotNone(s['codec'])
+                self.assertGreater(s['channels'], 0)
+
+            self._app.stop()
+        t = threading.Thread(target=f)
+        t.start()
+        self._app.run()
+        t.join()
+
+    def test_enqueue_too_big(self):
+        '''Test enqueuing a song bigger than the maximum size.'''
+        self._app = musicserver.Application(os.path.join(TEST_PATH, 'config5'))
+        def f():
+            self._waitready()
+            song = os.path.join(TEST_PATH, 'song1.webm')
+            # The server answers 400 and closes the connection while the song
+            # is being sent, so the client may see the connection reset
+            # instead of the answer
+            with self.assertRaises(urllib.error.URLError):
+                self._enqueue(song, 'mysong')
+
+            # Check the status
+            self._check([], None, 'stop')
+
+            self._app.stop()
+        t = threading.Thread(target=f)
+        t.start()
+        self._app.run()
+        t.join()
+
+    def test_enqueue_not_decodable(self):
+        '''Test enqueuing a file that is not a song.'''
+        self._app = musicserver.Application(os.path.join(TEST_PATH, 'config2'))
+        def f():
+            self._waitready()
+            song = os.path.join(TEST_PATH, 'config1')
+            url = 'http://localhost:8888/musicserver/enqueue?title=mysong'
+            request = urllib.request.Request(url, open(song, 'rb'),
+                headers={'Content-Length': os.stat(song).st_size})
+            with urllib.request.urlopen(request) as f:
+                response = json.loads(f.read())
+            self.assertEquals(response['error'], True)
+            self.assertEquals(response['errmsg'], 'song not decodable')
+
+            # Check the status
+            self._check([], None, 'stop')
+
+            self._app.stop()
+        t = threading.Thread(target=f)
+        t.start()
+        self._app.run()
+        t.join()
+
+    def test_skip_errors(self):
+        '''Test skipping the songs that fail to play, until too many fail in
+        a row.
+        '''
+        config = os.path.join(TEST_PATH, 'config14')
+        with open(config) as f:
+            songdir = json.loads(f.read())['musicserver']['songdir']
+        self._app = musicserver.Application(config)
+        tmpdir = tempfile.mkdtemp(prefix='musicserver-test-')
+        def f():
+            self._waitready()
+            self._clear()
+            song = os.path.join(TEST_PATH, 'song1.webm')
+
+            # A song that fails is skipped
+            self._enqueuebroken(song, 1, songdir, tmpdir)
+            self._enqueue(song, 'mysong')
+            self._play()
+            time.sleep(1.0)
+            self._check(['broken1', 'mysong'], 1, 'play')
+            self.assertEquals(self._stats()['playererrors'], 1)
+
+            # The player stops when too many songs fail in a row
+            self._clear()
+            self._enqueuebroken(song, 2, songdir, tmpdir)
+            self._enqueuebroken(song, 3, songdir, tmpdir)
+            self._enqueue(song, 'mysong')
+            self._play()
+            time.sleep(1.0)
+            self._check(['broken2', 'broken3', 'mysong'], 1, 'stop')
+            self.assertEquals(self._stats()['playererrors'], 3)
+
+            self._app.stop()
+        t = threading.Thread(target=f)
+        t.start()
+        try:
+            self._app.run()
+            t.join()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def _enqueuebroken(self, song, n, songdir, tmpdir):
+        '''Enqueue a copy of a song, made different by n bytes at its end,
+        and remove its file from the songs directory, so it fails to play.
+        '''
+        with open(song, 'rb') as f:
+            data = f.read() + n * b'\0'
+        path = os.path.join(tmpdir, f'broken{n}')
+        with open(path, 'wb') as f:
+            f.write(data)
+        self._enqueue(path, f'broken{n}')
+        os.unlink(os.path.join(songdir, hashlib.sha256(data).hexdigest()))
+
+    def _stats(self):
+        '''Retrieve the statistics from the music server.'''
+        url = 'http://localhost:8888/musicserver/stats'
+        with urllib.request.urlopen(url) as f:
+            response = json.loads(f.read())
+        self.assertEquals(response['error'], False)
+        return response['data']
+
+    def test_enqueuehash(self):
+        '''Test enqueuing a song already stored given its hash.'''
+        self._app = musicserver.Application(os.path.join(TEST_PATH, 'config2'))
+        def f():
+            self._waitready()
+            song = os.path.join(TEST_PATH, 'song1.webm')
+            with open(song, 'rb') as s:
+                hash_ = hashlib.sha256(s.read()).hexdigest()
+            other = 64 * '0'
+
+            # The song is not stored yet
+            self._has([hash_, other], [])
+            self._enqueuehash(
+                hash_, 'mysong', error=True, errmsg='song not stored')
+            self._check([], None, 'stop')
+
+            # Store the song and enqueue it again by its hash
+            self._enqueue(song, 'mysong')
+            self._has([hash_, other], [hash_])
+            self._enqueuehash(hash_, 'mysong2')
+            self._check(['mysong', 'mysong2'], 0, 'stop')
+
+            # Once removed, the song is kept in the cache
+            self._clear()
+            self._has([hash_], [hash_])
+            self._enqueuehash(hash_, 'mysong3')
+            self._check(['mysong3'], 0, 'stop')
+
+            self._app.stop()
+        t = threading.Thread(target=f)
+        t.start()
+        self._app.run()
+        t.join()
+
+    def test_status_version(self):
+        '''Test the version of the status.'''
+        self._app = musicserver.Application(os.path.join(TEST_PATH, 'config2'))
+        def f():
+            self._waitready()
+            url = 'http://localhost:8888/musicserver/status'
+            with urllib.request.urlopen(url) as f:
+                etag = f.headers['Etag']
+                version = json.loads(f.read())['data']['version']
+            self.assertEquals(etag, f'"{version}"')
+
+            # The status has not changed
+            request = urllib.request.Request(
+                url, headers={'If-None-Match': etag})
+            with self.assertRaises(urllib.error.HTTPError) as cm:
+                urllib.request.urlopen(request)
+            self.assertEquals(cm.exception.code, 304)
+
+            # Wait for a change that doesn't arrive
+            start = time.time()
+            status = self._statussince(version, 0.5)
+            self.assertTrue(time.time() - start >= 0.5)
+            self.assertEquals(status['version'], version)
+
+            # Wait for a change that arrives
+            def g():
+                time.sleep(SLEEPTIME)
+                song = os.path.join(TEST_PATH, 'song1.webm')
+                self._enqueue(song, 'mysong')
+            t = threading.Thread(target=g)
+            t.start()
+            status = self._statussince(version, 10.0)
+            t.join()
+            self.assertNotEquals(status['version'], version)
+            self.assertEquals(len(status['playlist']['songs']), 1)
+
+            self._app.stop()
+        t = threading.Thread(target=f)
+        t.start()
+        self._app.run()
+        t.join()
+
+    def test_status_restart(self):
+        '''Test that the status of a previous start of the server is not
+        taken as the current one.
+        '''
+        url = 'http://localhost:8888/musicserver/status'
+        previous = {}
+        self._app = musicserver.Application(os.path.join(TEST_PATH, 'config2'))
+        def f():
+            self._waitready()
+            with urllib.request.urlopen(url) as f:
+                previous['etag'] = f.headers['Etag']
+                previous['version'] = json.loads(f.read())['data']['version']
+            self._app.stop()
+        t = threading.Thread(target=f)
+        t.start()
+        self._app.run()
+        t.join()
+
+        # Restart the server, with a fresh version
+        self._app = musicserver.Application(os.path.join(TEST_PATH, 'config2'))
+        def g():
+            self._waitready()
+            request = urllib.request.Request(
+                url, headers={'If-None-Match': previous['etag']})
+            with urllib.request.urlopen(request) as f:
+                self.assertEquals(f.status, 200)
+                self.assertNotEquals(f.headers['Etag'], previous['etag'])
+
+            # Waiting for a change of the previous version doesn't wait
+            start = time.time()
+            status = self._statussince(previous['version'], 10.0)
+            self.assertTrue(time.time() - start < 5.0)
+            self.assertNotEquals(status['version'], previous['version'])
+            self._app.stop()
+        t = threading.Thread(target=g)
+        t.start()
+        self._app.run()
+        t.join()
+
+    def test_status_window(self):
+        '''Test retrieving only a window of the playlist.'''
+        self._app = musicserver.Application(os.path.join(TEST_PATH, 'config6'))
+        def f():
+            self._waitready()
+            song = os.path.join(TEST_PATH, 'song1.webm')
+            titles = [f'mysong{i}' for i in range(5)]
+            for title in titles:
+                self._enqueue(song, title)
+            self._next()
+            self._next()
+
+            # The songs around the current one
+            url = ('http://localhost:8888/musicserver/status'
+                '?around=current&offset=-1&limit=3&fields=title')
+            with urllib.request.urlopen(url) as f:
+                self.assertEquals(f.headers['X-Playlist-Count'], '5')
+                status = json.loads(f.read())['data']
+            self.assertEquals(status['playlist']['songs'],
+                [{'title': t} for t in titles[1:4]])
+            self.assertEquals(status['playlist']['offset'], 1)
+            self.assertEquals(status['playlist']['total'], 5)
+            self.assertEquals(status['playlist']['current'], 2)
+
+            # Only the totals
+            url = 'http://localhost:8888/musicserver/status?limit=0'
+            with urllib.request.urlopen(url) as f:
+                self.assertEquals(f.headers['X-Playlist-Count'], '5')
+                status = json.loads(f.read())['data']
+            self.assertEquals(status['playlist']['songs'], [])
+
+            self._app.stop()
+        t = threading.Thread(target=f)
+        t.start()
+        self._app.run()
+        t.join()
+
+    def _statussince(self, version, timeout):
+        '''Retrieve the status once its version is greater than the given
+        one.
+        '''
+        url = ('http://localhost:8888/musicserver/status'
+            f'?since={version}&timeout={timeout}')
+        with urllib.request.urlopen(url) as f:
+            response = json.loads(f.read())
+        self.assertEquals(response['error'], False)
+        return response['data']
+
+    def test_events(self):
+        '''Test subscribing to the changes of state.'''
+        self._app = musicserver.Application(os.path.join(TEST_PATH, 'config2'))
+        def f():
+            self._waitready()
+            url = 'http://localhost:8888/musicserver/events'
+            with urllib.request.urlopen(url) as events:
+                # The first event is the full status
+                event = self._event(events)
+                self.assertEquals(event['type'], 'snapshot')
+                self.assertEquals(event['data']['playlist']['songs'], [])
+
+                # Enqueue a song
+                song = os.path.join(TEST_PATH, 'song1.webm')
+                self._enqueue(song, 'mysong')
+                event = self._event(events)
+                self.assertEquals(event['type'], 'insert')
+                self.assertEquals(event['index'], 0)
+                self.assertEquals(event['song']['title'], 'mysong')
+                event = self._event(events)
+                self.assertEquals(event['type'], 'current')
+                self.assertEquals(event['current'], 0)
+
+            self._app.stop()
+        t = threading.Thread(target=f)
+        t.start()
+        self._app.run()
+        t.join()
+
+    def _event(self, events):
+        '''Read the next event from a subscription.'''
+        for line in events:
+            if line.startswith(b'data: '):
+                return json.loads(line[len(b'data: '):])
+
+    def _has(self, hashes, expected):
+        '''Check which songs are stored in the server.'''
+        hashes = ','.join(hashes)
+        url = f'http://localhost:8888/musicserver/has?hash={hashes}'
+        with urllib.request.urlopen(url) as f:
+            response = json.loads(f.read())
+        self.assertEquals(response['error'], False)
+        self.assertEquals(response['data'], expected)
+
+    def _enqueuehash(self, hash_, title, error=False, errmsg=None):
+        '''Enqueue a song given its hash.'''
+        url = ('http://localhost:8888/musicserver/enqueuehash'
+            f'?hash={hash_}&title={title}')
+        with urllib.request.urlopen(url) as f:
+            response = json.loads(f.read())
+        self.assertEquals(response['error'], error)
+        if errmsg:
+            self.assertEquals(response['errmsg'], errmsg)
+        if not response['error']:
+            self.assertEquals(response['data'], None)
+
+    def _enqueue(self, song, title, zone=None):
         '''Enqueue a song.'''
         headers = {
             'Content-Type': 'audio/mp4',
             'Content-Length': os.stat(song).st_size,
         }
-        url = f'http://localhost:8888/musicserver/enqueue?title={title}'
+        base = 'musicserver' if zone is None else f'musicserver/{zone}'
+        url = f'http://localhost:8888/{base}/enqueue?title={title}'
         request = urllib.request.Request(
             url, open(song, 'rb'), headers=headers)
         with urllib.request.urlopen(request) as f:
@@ -481,6 +907,361 @@ class MusicServerTestCase(unittest.TestCase):
         if not response['error']:
             self.assertEquals(response['data'], None)
 
+    def test_insert_move(self):
+        '''Test inserting, moving and removing songs by id.'''
+        self._app = musicserver.Application(os.path.join(TEST_PATH, 'config6'))
+        def f():
+            self._waitready()
+            song = os.path.join(TEST_PATH, 'song1.webm')
+            with open(song, 'rb') as s:
+                hash_ = hashlib.sha256(s.read()).hexdigest()
+            self._enqueue(song, 'mysong1')
+            self._enqueue(song, 'mysong2')
+            self._next()
+            self._check(['mysong1', 'mysong2'], 1, 'stop')
+
+            # Insert before the current song
+            self._call(f'insert?index=0&title=mysong0&hash={hash_}')
+            self._check(['mysong0', 'mysong1', 'mysong2'], 2, 'stop')
+            self._call(f'insert?index=-1&title=mysong0&hash={hash_}',
+                error=True, errmsg='index must be non-negative')
+
+            # Move the current song
+            self._call('move?src=2&dst=0')
+            self._check(['mysong2', 'mysong0', 'mysong1'], 0, 'stop')
+            self._call('move?src=1&dst=2')
+            status = self._check(['mysong2', 'mysong1', 'mysong0'], 0, 'stop')
+            self._call('move?src=1&dst=3', error=True, errmsg='wrong index')
+
+            # Remove a song by its id
+            id_ = status['playlist']['songs'][1]['id']
+            self._call(f'removeid?id={id_}')
+            self._check(['mysong2', 'mysong0'], 0, 'stop')
+            self._call(f'removeid?id={id_}',
+                error=True, errmsg='unknown song id')
+
+            self._app.stop()
+        t = threading.Thread(target=f)
+        t.start()
+        self._app.run()
+        t.join()
+
+    def _call(self, method, error=False, errmsg=None):
+        '''Call a web service method that returns nothing.'''
+        url = f'http://localhost:8888/musicserver/{method}'
+        with urllib.request.urlopen(url) as f:
+            response = json.loads(f.read())
+        self.assertEquals(response['error'], error)
+        if errmsg:
+            self.assertEquals(response['errmsg'], errmsg)
+        if not response['error']:
+            self.assertEquals(response['data'], None)
+
+    def test_batch(self):
+        '''Test executing many methods in one request.'''
+        self._app = musicserver.Application(os.path.join(TEST_PATH, 'config6'))
+        def f():
+            self._waitready()
+            song = os.path.join(TEST_PATH, 'song1.webm')
+            with open(song, 'rb') as s:
+                hash_ = hashlib.sha256(s.read()).hexdigest()
+            self._enqueue(song, 'mysong1')
+
+            # Execute some methods
+            response = self._batch([
+                {'method': 'enqueuehash',
+                    'args': {'title': 'mysong2', 'hash': hash_}},
+                {'method': 'setvolume', 'args': {'volume': 0.5}},
+                {'method': 'unknown'},
+            ])
+            self.assertEquals(response['error'], False)
+            self.assertEquals([r['error'] for r in response['data']],
+                [False, False, True])
+            self._check(['mysong1', 'mysong2'], 0, 'stop', volume=0.5)
+
+            # An atomic batch that fails changes nothing
+            response = self._batch([
+                {'method': 'clear'},
+                {'method': 'enqueuehash',
+                    'args': {'title': 'mysong3', 'hash': hash_}},
+                {'method': 'setvolume', 'args': {'volume': 2}},
+            ], atomic=True)
+            self.assertEquals(response['error'], True)
+            self.assertEquals(
+                response['errmsg'], 'command 2 failed: wrong volume')
+            self._check(['mysong1', 'mysong2'], 0, 'stop', volume=0.5)
+
+            # The status can't be waited for inside a batch, and the ETag
+            # of the request doesn't apply to the methods of the batch
+            etag = '"{}"'.format(self._status()['version'])
+            response = self._batch([
+                {'method': 'status', 'args': {'since': '0.0'}},
+                {'method': 'status'},
+            ], headers={'If-None-Match': etag})
+            self.assertEquals([r['error'] for r in response['data']],
+                [True, False])
+            self.assertEquals(response['data'][0]['errmsg'],
+                'since not allowed in batches')
+            response = self._batch([
+                {'method': 'status', 'args': {'since': '0.0'}},
+            ], atomic=True)
+            self.assertEquals(response['error'], True)
+
+            self._app.stop()
+        t = threading.Thread(target=f)
+        t.start()
+        self._app.run()
+        t.join()
+
+    def _batch(self, commands, atomic=False, headers={}):
+        '''Execute a batch of methods.'''
+        url = 'http://localhost:8888/musicserver/batch'
+        if atomic:
+            url += '?atomic=true'
+        request = urllib.request.Request(url, json.dumps(commands).encode(
+            'utf-8'), headers={'Content-Type': 'application/json', **headers})
+        with urllib.request.urlopen(request) as f:
+            return json.loads(f.read())
+
+    def test_workers(self):
+        '''Test serving the requests from many worker processes.'''
+        self._app = musicserver.Application(os.path.join(TEST_PATH, 'config7'))
+        def f():
+            self._waitready()
+
+            # Wait until the workers listen
+            while True:
+                try:
+                    self._status()
+                    break
+                except urllib.error.URLError:
+                    time.sleep(0.1)
+            self._clear()
+            song = os.path.join(TEST_PATH, 'song1.webm')
+            self._enqueue(song, 'mysong')
+            time.sleep(SLEEPTIME)
+            self._check(['mysong'], 0, 'stop')
+            self._app.stop()
+        t = threading.Thread(target=f)
+        t.start()
+        self._app.run()
+        t.join()
+
+    def test_workers_unixsocket(self):
+        '''Test serving the requests from many worker processes only in a
+        Unix domain socket.
+        '''
+        self._app = musicserver.Application(
+            os.path.join(TEST_PATH, 'config13'))
+        def f():
+            self._waitready()
+
+            # Wait until a worker listens
+            while True:
+                try:
+                    status = self._unixget(
+                        '/tmp/musicserver-test.sock', '/musicserver/status')
+                    break
+                except (ConnectionRefusedError, FileNotFoundError):
+                    time.sleep(0.1)
+            self.assertEquals(status['error'], False)
+            self._app.stop()
+        t = threading.Thread(target=f)
+        t.start()
+        self._app.run()
+        t.join()
+
+    def _unixget(self, path, url):
+        '''Send a GET request to a server listening in a Unix domain socket
+        and return its response.
+        '''
+        connection = UnixHTTPConnection(path)
+        try:
+            connection.request('GET', url)
+            return json.loads(connection.getresponse().read())
+        finally:
+            connection.close()
+
+    def test_zones(self):
+        '''Test playing in many zones that share the songs.'''
+        self._app = musicserver.Application(os.path.join(TEST_PATH, 'config8'))
+        def f():
+            self._waitready()
+            song = os.path.join(TEST_PATH, 'song1.webm')
+            with open(song, 'rb') as s:
+                hash_ = hashlib.sha256(s.read()).hexdigest()
+
+            # The song uploaded to a zone can be enqueued in the others
+            self._zone('kitchen', 'clear')
+            self._zone('livingroom', 'clear')
+            self._enqueue(song, 'mysong1', zone='kitchen')
+            self._zone('livingroom', f'enqueuehash?title=mysong2&hash={hash_}')
+            self._zone('livingroom', 'play')
+            time.sleep(SLEEPTIME)
+            status = self._zone('kitchen', 'status')
+            self.assertEquals(
+                [s['title'] for s in status['playlist']['songs']], ['mysong1'])
+            self.assertEquals(status['player']['state'], 'stop')
+            status = self._zone('livingroom', 'status')
+            self.assertEquals(
+                [s['title'] for s in status['playlist']['songs']], ['mysong2'])
+            self.assertEquals(status['player']['state'], 'play')
+            self._app.stop()
+        t = threading.Thread(target=f)
+        t.start()
+        self._app.run()
+        t.join()
+
+    def _zone(self, zone, method):
+        '''Call a method of a zone and return its data.'''
+        url = f'http://localhost:8888/musicserver/{zone}/{method}'
+        with urllib.request.urlopen(url) as f:
+            response = json.loads(f.read())
+        self.assertEquals(response['error'], False)
+        return response['data']
+
+    def test_sync(self):
+        '''Test playing in sync in two processes.'''
+        self._app = musicserver.Application(os.path.join(TEST_PATH, 'config9'))
+        def f():
+            self._waitready()
+            self._clear()
+            song = os.path.join(TEST_PATH, 'song1.webm')
+            self._enqueue(song, 'mysong')
+
+            # Start the follower, that finds the song in the directory
+            follower = subprocess.Popen([sys.executable,
+                os.path.join(ROOT_PATH, 'music-server'),
+                '-c', os.path.join(TEST_PATH, 'config10')])
+            try:
+                url = 'http://localhost:8889/musicserver/status'
+                while True:
+                    try:
+                        with urllib.request.urlopen(url) as f:
+                            break
+                    except urllib.error.URLError:
+                        time.sleep(0.1)
+
+                # The follower plays the same song at the same position
+                self._play()
+                time.sleep(1.0)
+                with urllib.request.urlopen(url) as f:
+                    status = json.loads(f.read())['data']
+                self.assertEquals(
+                    [s['title'] for s in status['playlist']['songs']],
+                    ['mysong'])
+                self.assertEquals(status['player']['state'], 'play')
+                leader = self._status()['player']['position']
+                self.assertAlmostEqual(
+                    status['player']['position'], leader, delta=0.1)
+
+                # And stops with the leader
+                self._stop()
+                time.sleep(SLEEPTIME)
+                with urllib.request.urlopen(url) as f:
+                    status = json.loads(f.read())['data']
+                self.assertEquals(status['player']['state'], 'stop')
+            finally:
+                follower.terminate()
+                follower.wait()
+            self._app.stop()
+        t = threading.Thread(target=f)
+        t.start()
+        self._app.run()
+        t.join()
+
+    def test_peers(self):
+        '''Test fetching the songs from another music server.'''
+        self._app = musicserver.Application(os.path.join(TEST_PATH, 'config1'))
+        def f():
+            self._waitready()
+            self._clear()
+            song = os.path.join(TEST_PATH, 'song1.webm')
+            with open(song, 'rb') as s:
+                hash_ = hashlib.sha256(s.read()).hexdigest()
+            self._enqueue(song, 'mysong')
+
+            # Start the other server, without songs
+            shutil.rmtree('/home/toni/projects/music-server/songs-peer',
+                ignore_errors=True)
+            peer = subprocess.Popen([sys.executable,
+                os.path.join(ROOT_PATH, 'music-server'),
+                '-c', os.path.join(TEST_PATH, 'config11')])
+            try:
+                url = 'http://localhost:8889/musicserver'
+                while True:
+                    try:
+                        with urllib.request.urlopen(f'{url}/songs') as f:
+                            songs = json.loads(f.read())['data']
+                            break
+                    except urllib.error.URLError:
+                        time.sleep(0.1)
+                self.assertNotIn(hash_, songs)
+
+                # The song is fetched when it's enqueued by its hash
+                with urllib.request.urlopen(
+                        f'{url}/enqueuehash?hash={hash_}&title=mysong') as f:
+                    self.assertEquals(json.loads(f.read())['error'], False)
+                with urllib.request.urlopen(f'{url}/songs') as f:
+                    self.assertIn(hash_, json.loads(f.read())['data'])
+
+                # And there's nothing else to fetch
+                with urllib.request.urlopen(f'{url}/seed') as f:
+                    self.assertEquals(json.loads(f.read())['data'], [])
+
+                # The unknown songs are not fetched
+                with urllib.request.urlopen(
+                        f'{url}/enqueuehash?hash={64 * "0"}&title=a') as f:
+                    response = json.loads(f.read())
+                self.assertEquals(response['error'], True)
+                self.assertEquals(response['errmsg'], 'song not stored')
+            finally:
+                peer.terminate()
+                peer.wait()
+            self._app.stop()
+        t = threading.Thread(target=f)
+        t.start()
+        self._app.run()
+        t.join()
+
+    def test_stream(self):
+        '''Test listening to the live stream of the player.'''
+        self._app = musicserver.Application(
+            os.path.join(TEST_PATH, 'config12'))
+        def f():
+            self._waitready()
+            self._clear()
+            song = os.path.join(TEST_PATH, 'song1.webm')
+            self._enqueue(song, 'mysong')
+            self._play()
+
+            # Two listeners receive the same MP3 stream
+            url = 'http://localhost:8888/musicserver/stream'
+            with urllib.request.urlopen(url) as f1, \
+                    urllib.request.urlopen(url) as f2:
+                for f in (f1, f2):
+                    self.assertEquals(
+                        f.headers['Content-Type'], 'audio/mpeg')
+                    data = f.read(4096)
+                    self.assertEquals(len(data), 4096)
+                    self.assertEquals(data[0], 0xff)
+                    self.assertEquals(data[1] & 0xe0, 0xe0)
+
+                # And there can't be more listeners
+                with self.assertRaises(urllib.error.HTTPError) as cm:
+                    urllib.request.urlopen(url)
+                self.assertEquals(cm.exception.code, 503)
+                with urllib.request.urlopen(
+                        'http://localhost:8888/musicserver/stats') as f:
+                    stats = json.loads(f.read())['data']
+                self.assertEquals(stats['listeners'], 2)
+            self._stop()
+            self._app.stop()
+        t = threading.Thread(target=f)
+        t.start()
+        self._app.run()
+        t.join()
+
     def test_seek(self):
         '''Test seeking into a song.'''
         self._app = musicserver.Application(os.path.join(TEST_PATH, 'config4'))
@@ -639,3 +1420,207 @@ class MusicServerTestCase(unittest.TestCase):
         if not response['error']:
             self.assertEquals(response['data'], None)
 
+
+class SongStoreTestCase(unittest.TestCase):
+    '''Test the store of songs.'''
+
+    def setUp(self):
+        self._songdir = tempfile.mkdtemp(prefix='musicserver-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self._songdir)
+
+    def _run(self, test):
+        '''Run a coroutine function that returns a store in the IOLoop,
+        letting the files be deleted in the background before closing the
+        store.
+        '''
+        async def run():
+            store = await test()
+            await asyncio.sleep(SLEEPTIME)
+            store.close()
+        tornado.ioloop.IOLoop.current().run_sync(run)
+
+    def _exists(self, hash_):
+        '''Return whether the file of a song exists.'''
+        return os.path.exists(os.path.join(self._songdir, hash_))
+
+    def test_cache_count(self):
+        '''Test that the least recently used songs not referenced are
+        removed when there are too many.
+        '''
+        async def test():
+            store = musicserver.SongStore(self._songdir, maxcount=2)
+            a = await store.store(b'a')
+            b = await store.store(b'b')
+            c = await store.store(b'c')
+
+            # The songs referenced are never removed
+            self.assertEquals(store.has([a, b, c]), [a, b, c])
+            store.release(a)
+            self.assertEquals(store.has([a, b, c]), [b, c])
+            store.release(b)
+            store.release(c)
+
+            # The song used again is the most recently used one
+            self.assertTrue(await store.acquire(b))
+            store.release(b)
+            d = await store.store(b'd')
+            self.assertEquals(store.has([b, c, d]), [b, d])
+            return store
+        self._run(test)
+        self.assertEquals(len(os.listdir(self._songdir)), 2)
+
+    def test_concurrent_uploads(self):
+        '''Test that the same song uploaded concurrently is stored once, with
+        a reference for each upload, even if one of them fails.
+        '''
+        async def test():
+            store = musicserver.SongStore(self._songdir, maxcount=0)
+            uploads = [store.newupload() for i in range(3)]
+            for chunk in (b'my', b'song'):
+                await asyncio.gather(*(u.write(chunk) for u in uploads))
+
+            # The last upload is aborted while the others are stored
+            uploads[2].discard()
+            a, b = await asyncio.gather(
+                *(store.storeupload(u) for u in uploads[:2]))
+            self.assertEquals(a, b)
+            self.assertEquals(a, hashlib.sha256(b'mysong').hexdigest())
+            await asyncio.sleep(SLEEPTIME)
+            self.assertEquals(os.listdir(self._songdir), [a])
+
+            # The song is removed only when both references are released
+            store.release(a)
+            self.assertEquals(store.has([a]), [a])
+            store.release(b)
+            self.assertEquals(store.has([a]), [])
+            return store
+        self._run(test)
+        self.assertEquals(os.listdir(self._songdir), [])
+
+    def test_cache_size(self):
+        '''Test that the least recently used songs not referenced are
+        removed when they take too much space.
+        '''
+        async def test():
+            store = musicserver.SongStore(self._songdir, maxsize=10)
+            a = await store.store(b'12345')
+            b = await store.store(b'67890')
+            store.release(a)
+            store.release(b)
+            self.assertEquals(store.has([a, b]), [a, b])
+            c = await store.store(b'abc')
+            self.assertEquals(store.has([a, b, c]), [b, c])
+            return store
+        self._run(test)
+        self.assertEquals(len(os.listdir(self._songdir)), 2)
+
+    def test_cache_restart(self):
+        '''Test that the order of the cache is rebuilt from the modification
+        times of the files.
+        '''
+        a, b, c = (x * 64 for x in 'abc')
+        for mtime, hash_ in enumerate((b, c, a), 1):
+            path = os.path.join(self._songdir, hash_)
+            with open(path, 'wb') as f:
+                f.write(b'song')
+            os.utime(path, (mtime, mtime))
+        async def test():
+            store = musicserver.SongStore(self._songdir, maxcount=2)
+            self.assertEquals(store.has([a, b, c]), [a, c])
+            return store
+        self._run(test)
+        self.assertFalse(self._exists(b))
+
+    def test_prefetch_zones(self):
+        '''Test that the songs prefetched by a zone are not dropped from the
+        page cache by the other zones.
+        '''
+        a, b, c = (x * 64 for x in 'abc')
+        for hash_ in (a, b, c):
+            with open(os.path.join(self._songdir, hash_), 'wb') as f:
+                f.write(b'song')
+        store = musicserver.SongStore(self._songdir)
+        advice = []
+        store._advise = lambda path, advise: advice.append(
+            (os.path.basename(path), advise))
+        kitchen, livingroom = object(), object()
+
+        # The windows of both zones are read ahead, the shared song once
+        store.prefetch(kitchen, [a, b])
+        store.prefetch(livingroom, [b, c])
+        store.prefetch(livingroom, [b, c])
+
+        # Only the songs out of every window are dropped
+        store.prefetch(kitchen, [c])
+        store.prefetch(livingroom, [c])
+        store._executor.shutdown(wait=True)
+        willneed = musicserver._FADV_WILLNEED
+        dontneed = musicserver._FADV_DONTNEED
+        self.assertCountEqual(advice, [(a, willneed), (b, willneed),
+            (c, willneed), (a, dontneed), (b, dontneed)])
+        store.close()
+
+class MetadataStoreTestCase(unittest.TestCase):
+    '''Test the store of the metadata of the songs.'''
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp(prefix='musicserver-test-')
+        self._path = os.path.join(self._dir, 'metadata.db')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_persistence(self):
+        '''Test that the metadata is written in batches and loaded again.'''
+        a, b = 'a' * 64, 'b' * 64
+        async def test():
+            metadata = musicserver.MetadataStore(self._path, 0.1)
+            m = metadata.get(a)
+            m.update({'discovered': True, 'duration': 12.5, 'codec': 'Opus',
+                'channels': 2, 'tags': {'title': 'mysong'}})
+            m.titles.append('mysong')
+            metadata.save(a)
+            metadata.get(b).decodable = False
+            metadata.save(b)
+
+            # The changes are written together after the interval
+            self.assertEquals(self._rows(), 0)
+            await asyncio.sleep(0.5)
+            self.assertEquals(self._rows(), 2)
+
+            # The changes pending are written when closed
+            metadata.get(a).plays += 1
+            metadata.save(a)
+            metadata.close()
+        tornado.ioloop.IOLoop.current().run_sync(test)
+
+        metadata = musicserver.MetadataStore(self._path)
+        m = metadata.get(a)
+        self.assertEquals((m.discovered, m.decodable, m.duration, m.codec,
+            m.channels, m.tags, m.titles, m.plays),
+            (True, True, 12.5, 'Opus', 2, {'title': 'mysong'}, ['mysong'], 1))
+        self.assertEquals(metadata.get(b).decodable, False)
+        metadata.close()
+
+    def test_titles(self):
+        '''Test that only the last titles of a song are remembered.'''
+        songdir = os.path.join(self._dir, 'songs')
+        store = musicserver.SongStore(songdir)
+        hash_ = 'a' * 64
+        for i in range(2 * musicserver.SongStore.MAX_TITLES):
+            store.addtitle(hash_, f'mysong{i}')
+        store.addtitle(hash_, 'mysong0')
+        titles = store.metadata(hash_).titles
+        self.assertEquals(len(titles), musicserver.SongStore.MAX_TITLES)
+        self.assertEquals(titles[-1], 'mysong0')
+        store.close()
+
+    def _rows(self):
+        '''Return the number of songs in the database.'''
+        connection = sqlite3.connect(self._path)
+        try:
+            return connection.execute('SELECT COUNT(*) FROM songs').fetchone()[0]
+        finally:
+            connection.close()